@@ -3,7 +3,15 @@
 
 from __future__ import unicode_literals
 
+import contextlib
+import errno
+import io
+import json
 import os
+import socket
+import subprocess
+import threading
+import time
 
 import pytest
 
@@ -17,9 +25,10 @@ except NameError:
 
 
 class FakePopen(object):
-    def __init__(self, stdout, stderr=b''):
+    def __init__(self, stdout, stderr=b'', returncode=0):
         self.stdout = stdout
         self.stderr = stderr
+        self.returncode = returncode
 
     def communicate(self):
         return self.stdout, self.stderr
@@ -387,3 +396,1470 @@ def test_setup_astounding_success(tmpdir):
         {str('Popen'): basic_version, str('version_file'): None,
          str('vcs_args'): []})
     assert dist.metadata.version == '1.0'
+
+def test_version_module_paths_substitutions(gitdir):
+    "Version module paths have some substitutions performed."
+    gitdir.join('spam').mkdir()
+    vcversioner.find_version(
+        Popen=basic_version, version_module_paths=['%(root)s/spam/_version.py'])
+    assert gitdir.join('spam', '_version.py').check()
+
+def test_version_module_template(gitdir):
+    "The template for version modules can be customized."
+    vcversioner.find_version(
+        Popen=dev_version, version_module_paths=['foo.py'],
+        version_module_template='v = {version}; c = {commits}; s = {sha}\n')
+    assert gitdir.join('foo.py').read() == "v = '1.0.post2'; c = '2'; s = 'gfeeb'\n"
+
+def test_unchanged_files_not_rewritten(gitdir):
+    "Files whose content wouldn't change are left alone."
+    vcversioner.find_version(Popen=basic_version, version_module_paths=['foo.py'])
+    for name in ['foo.py', 'version.txt']:
+        gitdir.join(name).setmtime(1)
+    vcversioner.find_version(Popen=basic_version, version_module_paths=['foo.py'])
+    for name in ['foo.py', 'version.txt']:
+        assert gitdir.join(name).mtime() == 1
+    vcversioner.find_version(Popen=dev_version, version_module_paths=['foo.py'])
+    for name in ['foo.py', 'version.txt']:
+        assert gitdir.join(name).mtime() != 1
+
+
+class CountingFakePopen(FakePopen):
+    def __init__(self, *a, **kw):
+        super(CountingFakePopen, self).__init__(*a, **kw)
+        self.calls = []
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append(args[0])
+        return self
+
+def test_stamp_versions(tmpdir):
+    "Many projects can be versioned at once, running each VCS command once."
+    tmpdir.chdir()
+    tmpdir.join('.git').mkdir()
+    popen = CountingFakePopen(b'spam-1.0-2-gfeeb')
+    versions = vcversioner.stamp_versions([
+        {'strip_prefix': 'spam-', 'version_module_paths': ['spam.py']},
+        {'strip_prefix': 'spam-', 'include_dev_version': False,
+         'version_module_paths': ['eggs.py']},
+    ], Popen=popen)
+    assert versions == [('1.0.post2', '2', 'gfeeb'), ('1.0', '2', 'gfeeb')]
+    assert len(popen.calls) == 1
+    assert "'1.0.post2'" in tmpdir.join('spam.py').read()
+    assert "'1.0'" in tmpdir.join('eggs.py').read()
+
+def test_stamp_versions_Popen_raises(tmpdir):
+    "A VCS which fails to spawn is only tried once."
+    tmpdir.chdir()
+    tmpdir.join('.git').mkdir()
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    popen = RaisingFakePopen()
+    calls = []
+    def counting_popen(*args, **kwargs):
+        calls.append(args)
+        return popen(*args, **kwargs)
+    versions = vcversioner.stamp_versions([{}, {}], Popen=counting_popen)
+    assert versions == [('1.0', '0', 'gbeef')] * 2
+    assert len(calls) == 1
+
+def test_stamp_versions_dirty_check_concurrent(tmpdir):
+    "The dirty check still runs while the VCS is being asked for a version."
+    tmpdir.chdir()
+    tmpdir.join('.git').mkdir()
+    events = []
+    class RecordingFakePopen(FakePopen):
+        def __init__(self, command, stdout):
+            super(RecordingFakePopen, self).__init__(stdout)
+            self.command = command
+        def __call__(self, args, **kwargs):
+            events.append(('spawn', self.command))
+            return self
+        def communicate(self):
+            events.append(('communicate', self.command))
+            return super(RecordingFakePopen, self).communicate()
+    popen = CommandFakePopen(
+        describe=RecordingFakePopen('describe', b'1.0-0-gbeef'),
+        status=RecordingFakePopen('status', b''))
+    versions = vcversioner.stamp_versions(
+        [{'check_dirty': True}] * 2, Popen=popen)
+    assert versions == [('1.0', '0', 'gbeef')] * 2
+    assert events == [
+        ('spawn', 'status'), ('spawn', 'describe'),
+        ('communicate', 'describe'), ('communicate', 'status')]
+
+def test_main_stamp(gitdir, capsys, monkeypatch):
+    "``python -m vcversioner stamp`` reads a JSON manifest."
+    gitdir.join('manifest.json').write('[{"version_file": null, "vcs_args": []}]')
+    monkeypatch.setattr(vcversioner, 'stamp_versions', lambda manifest: [
+        vcversioner.find_version(Popen=basic_version, **manifest[0])])
+    vcversioner.main(['stamp', 'manifest.json'])
+    out, err = capsys.readouterr()
+    assert out == '1.0\n'
+
+def test_main_usage(capsys):
+    "Bad command line arguments produce a usage message."
+    with pytest.raises(SystemExit) as excinfo:
+        vcversioner.main([])
+    assert excinfo.value.args[0] == 2
+    out, err = capsys.readouterr()
+    assert err.startswith('usage:')
+
+
+class FakeBackend(vcversioner.Backend):
+    name = 'fake'
+
+    def __init__(self, raw_version='1.0-0-gbeef', detected=True, fingerprint=None):
+        self.raw_version = raw_version
+        self.detected = detected
+        self._fingerprint = fingerprint
+        self.describe_calls = 0
+
+    def detect(self, substitute):
+        return self.detected
+
+    def describe(self, substitute, Popen):
+        self.describe_calls += 1
+        return self.raw_version, []
+
+    def fingerprint(self, substitute):
+        return self._fingerprint
+
+@pytest.fixture
+def clean_registry(monkeypatch):
+    monkeypatch.setattr(vcversioner, '_registered_backends', [])
+    monkeypatch.setattr(vcversioner, '_entry_point_backends', [])
+
+def test_custom_backends(tmpdir):
+    "The backends to try can be passed explicitly."
+    tmpdir.chdir()
+    version = vcversioner.find_version(
+        backends=[FakeBackend(detected=False), FakeBackend('2.0-1-gfeeb')],
+        Popen=RaisingFakePopen())
+    assert version == ('2.0.post1', '1', 'gfeeb')
+
+def test_register_backend(gitdir, clean_registry):
+    "Registered backends are tried before the built-in ones."
+    vcversioner.register_backend(FakeBackend('2.0-0-gfeeb'))
+    version = vcversioner.find_version(Popen=basic_version)
+    assert version == ('2.0', '0', 'gfeeb')
+
+def test_undetected_registered_backend(gitdir, clean_registry):
+    "Registered backends which aren't detected are skipped."
+    vcversioner.register_backend(FakeBackend(detected=False))
+    version = vcversioner.find_version(Popen=dev_version)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+
+def test_vcs_args_bypass_backends(gitdir, clean_registry):
+    "Explicit vcs_args are used instead of any backend."
+    vcversioner.register_backend(FakeBackend('2.0-0-gfeeb'))
+    version = vcversioner.find_version(Popen=basic_version, vcs_args=['git'])
+    assert version == ('1.0', '0', 'gbeef')
+
+def test_backend_failure_message(tmpdir, capsys):
+    "Backends are named in failure messages."
+    tmpdir.chdir()
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(backends=[FakeBackend('')], version_file=None)
+    out, err = capsys.readouterr()
+    assert out == "vcversioner: 'fake' failed.\n"
+
+
+class FakeEntryPoint(object):
+    def __init__(self, name, obj):
+        self.name = name
+        self.obj = obj
+
+    def load(self):
+        if isinstance(self.obj, Exception):
+            raise self.obj
+        return self.obj
+
+def test_entry_point_backends(monkeypatch, clean_registry):
+    "Backends can be registered through entry points, as instances or classes."
+    backend = FakeBackend()
+    monkeypatch.setattr(vcversioner, '_entry_point_backends', None)
+    monkeypatch.setattr(vcversioner, '_iter_entry_points', lambda group: [
+        FakeEntryPoint('instance', backend), FakeEntryPoint('class', FakeBackend)])
+    backends = vcversioner.get_backends()
+    assert backends[0] is backend
+    assert isinstance(backends[1], FakeBackend)
+    assert backends[2:] == vcversioner._builtin_backends
+
+def test_broken_entry_point_backend(monkeypatch, clean_registry):
+    "Entry points which fail to load are skipped with a warning."
+    monkeypatch.setattr(vcversioner, '_entry_point_backends', None)
+    monkeypatch.setattr(vcversioner, '_iter_entry_points', lambda group: [
+        FakeEntryPoint('broken', ImportError('nope'))])
+    with pytest.warns(UserWarning):
+        backends = vcversioner.get_backends()
+    assert backends == vcversioner._builtin_backends
+
+
+@pytest.fixture
+def git_metadata(gitdir):
+    git = gitdir.join('.git')
+    git.join('HEAD').write('ref: refs/heads/master\n')
+    git.join('refs', 'heads').ensure(dir=True).join('master').write('a' * 40 + '\n')
+    git.join('refs', 'tags').ensure(dir=True).join('v1.0').write('b' * 40 + '\n')
+    return git
+
+def git_fingerprint(gitdir):
+    backend = vcversioner.GitBackend()
+    substitutions, substitute = vcversioner._substituter(gitdir.strpath)
+    return backend.fingerprint(substitute)
+
+def test_git_fingerprint(gitdir, git_metadata):
+    "The git fingerprint changes with HEAD and the tags."
+    fingerprint = git_fingerprint(gitdir)
+    assert fingerprint.startswith('a' * 40 + ' ')
+    assert git_fingerprint(gitdir) == fingerprint
+    git_metadata.join('refs', 'tags', 'v1.1').write('c' * 40 + '\n')
+    assert git_fingerprint(gitdir) != fingerprint
+
+def test_git_fingerprint_packed_refs(gitdir, git_metadata):
+    "Refs can also come from packed-refs."
+    git_metadata.join('refs', 'heads', 'master').remove()
+    git_metadata.join('packed-refs').write(
+        '# pack-refs with: peeled\n'
+        + 'd' * 40 + ' refs/heads/master\n'
+        + 'e' * 40 + ' refs/tags/v0.9\n'
+        + '^' + 'f' * 40 + '\n')
+    fingerprint = git_fingerprint(gitdir)
+    assert fingerprint.startswith('d' * 40 + ' ')
+    git_metadata.join('packed-refs').write('d' * 40 + ' refs/heads/master\n')
+    assert git_fingerprint(gitdir) != fingerprint
+
+def test_git_fingerprint_no_head(gitdir):
+    "Without a readable HEAD, there's no fingerprint."
+    assert git_fingerprint(gitdir) is None
+
+def test_stamp_versions_fingerprint_cache(tmpdir):
+    "Backends with a fingerprint only describe each repository state once."
+    tmpdir.chdir()
+    backend = FakeBackend(fingerprint='spam')
+    vcversioner.stamp_versions(
+        [{'backends': [backend]}, {'backends': [backend]}],
+        Popen=RaisingFakePopen())
+    assert backend.describe_calls == 1
+
+def test_stamp_versions_without_fingerprint(tmpdir):
+    "Backends without a fingerprint aren't cached."
+    tmpdir.chdir()
+    backend = FakeBackend()
+    vcversioner.stamp_versions(
+        [{'backends': [backend]}, {'backends': [backend]}],
+        Popen=RaisingFakePopen())
+    assert backend.describe_calls == 2
+
+def test_benchmark_backends(tmpdir):
+    "Each detected backend gets timed."
+    tmpdir.chdir()
+    backend = FakeBackend()
+    results = vcversioner.benchmark_backends(
+        backends=[FakeBackend(detected=False), backend], repeat=3)
+    assert [name for name, seconds in results] == ['fake']
+    assert results[0][1] >= 0
+    assert backend.describe_calls == 3
+
+def test_benchmark_backends_unrunnable(tmpdir):
+    "A backend whose VCS can't be run is reported instead of timed."
+    tmpdir.chdir()
+    tmpdir.join('.hg').mkdir()
+    hg, = [b for b in vcversioner.get_backends() if b.name == 'hg']
+    results = vcversioner.benchmark_backends(
+        backends=[hg, FakeBackend()], Popen=RaisingFakePopen())
+    assert results == [('hg', None), ('fake', results[1][1])]
+    assert results[1][1] >= 0
+
+def test_main_benchmark(capsys, monkeypatch):
+    "``python -m vcversioner benchmark`` prints timings."
+    monkeypatch.setattr(vcversioner, 'benchmark_backends', lambda *a: [
+        ('git', 0.0123), ('hg', None)])
+    vcversioner.main(['benchmark'])
+    out, err = capsys.readouterr()
+    assert out == 'git: 12.3 ms\nhg: failed to run\n'
+
+def test_version_override(gitdir):
+    "An explicit version override skips the VCS entirely."
+    version = vcversioner.find_version(
+        version_override='v1.2-0-gfeeb', Popen=RaisingFakePopen())
+    assert version == ('1.2', '0', 'gfeeb')
+    assert gitdir.join('version.txt').read() == 'v1.2-0-gfeeb'
+
+def test_version_override_env(gitdir, monkeypatch):
+    "The version override can come from an environment variable."
+    monkeypatch.setenv('SPAM_VERSION', '1.2-3-gfeeb')
+    version = vcversioner.find_version(
+        version_override_env='SPAM_VERSION', Popen=RaisingFakePopen())
+    assert version == ('1.2.post3', '3', 'gfeeb')
+
+def test_version_override_env_unset(gitdir, monkeypatch):
+    "An unset or empty override variable is ignored."
+    monkeypatch.setenv('SPAM_VERSION', '')
+    version = vcversioner.find_version(
+        version_override_env='SPAM_VERSION', Popen=basic_version)
+    assert version == ('1.0', '0', 'gbeef')
+    monkeypatch.delenv('SPAM_VERSION')
+    version = vcversioner.find_version(
+        version_override_env='SPAM_VERSION', Popen=basic_version)
+    assert version == ('1.0', '0', 'gbeef')
+
+def test_version_override_precedence(gitdir, monkeypatch):
+    "An explicit override beats the environment."
+    monkeypatch.setenv('SPAM_VERSION', '1.2-0-gfeeb')
+    version = vcversioner.find_version(
+        version_override='1.3-0-gfeeb', version_override_env='SPAM_VERSION')
+    assert version == ('1.3', '0', 'gfeeb')
+
+def test_invalid_version_override(gitdir, capsys):
+    "Version overrides are validated like VCS output."
+    with pytest.raises(SystemExit) as excinfo:
+        vcversioner.find_version(version_override='1.2', Popen=RaisingFakePopen())
+    assert excinfo.value.args[0] == 2
+    out, err = capsys.readouterr()
+    assert out == (
+        "vcversioner: %r (from the version override) couldn't be parsed into a version.\n" % ('1.2',))
+
+def test_override_env_var():
+    "Override variable names are derived from project names."
+    assert vcversioner.override_env_var('spam-eggs.py') == 'VCVERSIONER_SPAM_EGGS_PY_VERSION'
+
+def test_setup_version_override(tmpdir, monkeypatch):
+    "The setup hook checks an override variable named after the project."
+    tmpdir.chdir()
+    monkeypatch.setenv('VCVERSIONER_SPAM_VERSION', '2.0-0-gfeeb')
+    dist = Struct()
+    dist.metadata = Struct()
+    dist.metadata.name = 'spam'
+    vcversioner.setup(
+        dist, 'vcversioner',
+        {str('Popen'): RaisingFakePopen(), str('version_file'): None})
+    assert dist.metadata.version == '2.0'
+
+
+class CommandFakePopen(object):
+    "Pick a FakePopen based on the subcommand being run."
+    def __init__(self, **popens):
+        self.popens = popens
+        self.calls = []
+
+    def __call__(self, args, **kwargs):
+        self.calls.append((args, kwargs))
+        for arg in args:
+            if arg in self.popens:
+                return self.popens[arg](args, **kwargs)
+        raise OSError('no such command')
+
+def test_dirty_working_tree(gitdir):
+    "Uncommitted changes are marked with a local version suffix."
+    popen = CommandFakePopen(
+        describe=dev_version, status=FakePopen(b' M spam.py\n'))
+    version = vcversioner.find_version(check_dirty=True, Popen=popen)
+    assert version == ('1.0.post2+dirty', '2', 'gfeeb')
+    assert version.dirty
+    assert gitdir.join('version.txt').read() == '1.0-2-gfeeb'
+    status_args, status_kwargs = popen.calls[0]
+    assert status_args == [
+        'git', '--git-dir', gitdir.join('.git').strpath,
+        '--work-tree', gitdir.strpath,
+        'status', '--porcelain', '--untracked-files=no']
+    assert status_kwargs['cwd'] == gitdir.strpath
+
+def test_clean_working_tree(gitdir):
+    "A clean working tree gets no suffix."
+    popen = CommandFakePopen(describe=basic_version, status=FakePopen(b''))
+    version = vcversioner.find_version(check_dirty=True, Popen=popen)
+    assert version == ('1.0', '0', 'gbeef')
+    assert not version.dirty
+
+def test_dirty_check_disabled_by_default(gitdir):
+    "The working tree isn't checked unless asked for."
+    popen = CommandFakePopen(describe=basic_version, status=FakePopen(b' M spam.py\n'))
+    version = vcversioner.find_version(Popen=popen)
+    assert version == ('1.0', '0', 'gbeef')
+    assert not version.dirty
+    assert len(popen.calls) == 1
+
+def test_dirty_check_failed(gitdir):
+    "If checking the working tree fails, it's assumed to be clean."
+    popen = CommandFakePopen(
+        describe=basic_version, status=FakePopen(b'junk', b'fatal', returncode=128))
+    version = vcversioner.find_version(check_dirty=True, Popen=popen)
+    assert version == ('1.0', '0', 'gbeef')
+
+def test_dirty_paths(gitdir):
+    "The dirty check can be restricted to some paths."
+    popen = CommandFakePopen(describe=basic_version, status=FakePopen(b''))
+    vcversioner.find_version(
+        check_dirty=True, dirty_paths=['spam', '%(root)s/eggs'], Popen=popen)
+    status_args, status_kwargs = popen.calls[0]
+    assert status_args[-3:] == ['--', 'spam', gitdir.join('eggs').strpath]
+
+def test_dirty_check_with_version_file(gitdir):
+    "Versions read from a version file are never dirty."
+    gitdir.join('version.txt').write('1.0-0-gbeef')
+    popen = CommandFakePopen(describe=empty, status=FakePopen(b' M spam.py\n'))
+    version = vcversioner.find_version(check_dirty=True, Popen=popen)
+    assert version == ('1.0', '0', 'gbeef')
+    assert not version.dirty
+
+def test_hg_dirty_check(hgdir):
+    "hg working trees can be checked too."
+    popen = CommandFakePopen(log=hg_version, status=FakePopen(b'M spam.py\n'))
+    version = vcversioner.find_version(check_dirty=True, Popen=popen)
+    assert version == ('1.0+dirty', '0', 'hgbeef')
+    assert popen.calls[0][0] == [
+        'hg', 'status', '-R', hgdir.strpath,
+        '--modified', '--added', '--removed', '--deleted']
+
+def test_dirty_check_unsupported(tmpdir):
+    "Backends which can't check for changes are assumed to be clean."
+    tmpdir.chdir()
+    version = vcversioner.find_version(check_dirty=True, backends=[FakeBackend()])
+    assert version == ('1.0', '0', 'gbeef')
+
+
+class ScopedGitFakePopen(object):
+    "Fake the git commands run to describe part of a repository."
+    def __init__(self, last_commit=b'feeb0000 feeb', describe=b'v1.0-5-gbeef',
+                 count=b'2', is_ancestor=True, tag_is_ancestor=True):
+        self.outputs = {
+            '-1': FakePopen(last_commit),
+            '--count': FakePopen(count),
+            'describe': FakePopen(describe),
+        }
+        self.is_ancestor = is_ancestor
+        self.tag_is_ancestor = tag_is_ancestor
+        self.calls = []
+
+    def __call__(self, args, **kwargs):
+        self.calls.append(args)
+        if 'merge-base' in args:
+            if args[-2].startswith('refs/tags/'):
+                is_ancestor = self.tag_is_ancestor
+            else:
+                is_ancestor = self.is_ancestor
+            return FakePopen(b'', returncode=0 if is_ancestor else 1)
+        for arg in args:
+            if arg in self.outputs:
+                return self.outputs[arg]
+        raise OSError('no such command')
+
+@pytest.fixture
+def spamdir(gitdir):
+    return gitdir.join('spam').ensure(dir=True)
+
+def test_version_path(gitdir, git_metadata, spamdir):
+    "Only commits touching the version path are counted."
+    popen = ScopedGitFakePopen()
+    version = vcversioner.find_version(version_path='spam', Popen=popen)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    git = ['git', '--git-dir', git_metadata.strpath, '--work-tree', gitdir.strpath]
+    assert popen.calls == [
+        git + ['describe', '--tags', '--long', 'HEAD'],
+        git + ['log', '-1', '--format=%H %h', 'HEAD', '--', 'spam'],
+        git + ['merge-base', '--is-ancestor', 'refs/tags/v1.0', 'feeb0000'],
+        git + ['rev-list', '--count', 'refs/tags/v1.0..feeb0000', '--', 'spam'],
+    ]
+
+def test_version_path_version_file(gitdir, git_metadata, spamdir):
+    "Each version path gets its own version file by default."
+    vcversioner.find_version(version_path='spam', Popen=ScopedGitFakePopen())
+    assert spamdir.join('version.txt').read() == 'v1.0-2-gfeeb'
+    assert not gitdir.join('version.txt').check()
+
+def test_version_path_explicit_version_file(gitdir, git_metadata, spamdir):
+    "An explicit version file is still used with a version path."
+    vcversioner.find_version(
+        version_path='spam', version_file='%(root)s/spam.txt',
+        Popen=ScopedGitFakePopen())
+    assert gitdir.join('spam.txt').read() == 'v1.0-2-gfeeb'
+    assert not spamdir.join('version.txt').check()
+
+def test_version_path_counts_incremental(gitdir, git_metadata, spamdir):
+    "New commits are counted from the last counted revision."
+    vcversioner.find_version(version_path='spam', Popen=ScopedGitFakePopen())
+    popen = ScopedGitFakePopen(last_commit=b'f00d0000 f00d', count=b'1')
+    version = vcversioner.find_version(version_path='spam', Popen=popen)
+    assert version == ('1.0.post3', '3', 'gf00d')
+    assert popen.calls[3][-3:] == ['--is-ancestor', 'feeb0000', 'f00d0000']
+    assert popen.calls[4][-4:] == ['--count', 'feeb0000..f00d0000', '--', 'spam']
+
+def test_version_path_counts_not_ancestor(gitdir, git_metadata, spamdir):
+    "Revisions not descended from the last counted one are counted in full."
+    vcversioner.find_version(version_path='spam', Popen=ScopedGitFakePopen())
+    popen = ScopedGitFakePopen(
+        last_commit=b'f00d0000 f00d', count=b'4', is_ancestor=False)
+    version = vcversioner.find_version(version_path='spam', Popen=popen)
+    assert version == ('1.0.post4', '4', 'gf00d')
+    assert popen.calls[4][-4:] == [
+        '--count', 'refs/tags/v1.0..f00d0000', '--', 'spam']
+
+def test_version_path_counts_cached(gitdir, git_metadata, spamdir):
+    "Counts of commits touching a path are saved and reused."
+    vcversioner.find_version(version_path='spam', Popen=ScopedGitFakePopen())
+    assert git_metadata.join('vcversioner-path-commits.json').check()
+    popen = ScopedGitFakePopen(count=b'')
+    version = vcversioner.find_version(version_path='spam', Popen=popen)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    assert len(popen.calls) == 2
+
+def test_version_path_tagged_later(gitdir, git_metadata, spamdir):
+    "A tag after the last commit touching the path is used as is."
+    popen = ScopedGitFakePopen(describe=b'v1.1-0-gbeef', tag_is_ancestor=False)
+    version = vcversioner.find_version(version_path='spam', Popen=popen)
+    assert version == ('1.1', '0', 'gfeeb')
+    assert not any('--count' in args for args in popen.calls)
+
+def test_version_path_untouched(gitdir, git_metadata):
+    "If no commits touched the path, the VCS failed."
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(
+            version_path='spam', version_file=None,
+            Popen=ScopedGitFakePopen(last_commit=b''))
+
+def test_match_prefix(gitdir):
+    "Only tags starting with the stripped prefix can be matched."
+    popen = ScopedGitFakePopen(describe=b'spam/v1.0-5-gfeeb')
+    version = vcversioner.find_version(
+        match_prefix=True, strip_prefix='spam/v', Popen=popen)
+    assert version == ('1.0.post5', '5', 'gfeeb')
+    assert popen.calls[0][-4:] == ['--long', '--match', 'spam/v*', 'HEAD']
+
+def test_version_path_unsupported(hgdir, capsys):
+    "Backends which can't limit versions to a path cause an abort."
+    with pytest.raises(SystemExit) as excinfo:
+        vcversioner.find_version(version_path='spam', Popen=hg_version)
+    assert excinfo.value.args[0] == 2
+    out, err = capsys.readouterr()
+    assert out.startswith("vcversioner: ['hg', 'log'")
+    assert out.endswith(" can't limit versions to a path or tag prefix.\n")
+
+pkg_info = """Metadata-Version: 1.1
+Name: spam
+Version: 1.0.post3
+Summary: spam
+
+Version: 9.9
+"""
+
+@pytest.fixture
+def sdistdir(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('PKG-INFO').write(pkg_info)
+    return tmpdir
+
+def test_sdist_version_file(sdistdir):
+    "Unpacked sdists use the version file without looking for a VCS."
+    sdistdir.join('.git').mkdir()
+    sdistdir.join('version.txt').write('1.0-3-gbeef')
+    sdistdir.join('version.txt').setmtime(1)
+    version = vcversioner.find_version(
+        Popen=RaisingFakePopen(), version_module_paths=['foo.py'])
+    assert version == ('1.0.post3', '3', 'gbeef')
+    assert sdistdir.join('version.txt').mtime() == 1
+    assert not sdistdir.join('foo.py').check()
+
+def test_sdist_pkg_info(sdistdir):
+    "Without a version file, unpacked sdists use PKG-INFO."
+    version = vcversioner.find_version(
+        Popen=RaisingFakePopen(), version_module_paths=['foo.py'])
+    assert version == ('1.0.post3', '3', '')
+    assert not sdistdir.join('version.txt').check()
+    assert not sdistdir.join('foo.py').check()
+
+def test_sdist_pkg_info_no_version_file(sdistdir):
+    "PKG-INFO is used if the version file is disabled."
+    sdistdir.join('PKG-INFO').write('Name: spam\nVersion: 2.0\n')
+    version = vcversioner.find_version(Popen=RaisingFakePopen(), version_file=None)
+    assert version == ('2.0', '0', '')
+
+def test_sdist_pkg_info_invalid(sdistdir, capsys):
+    "A PKG-INFO without a version is an error."
+    sdistdir.join('PKG-INFO').write('Name: spam\n')
+    with pytest.raises(SystemExit) as excinfo:
+        vcversioner.find_version(Popen=RaisingFakePopen())
+    assert excinfo.value.args[0] == 2
+    out, err = capsys.readouterr()
+    assert out == "vcversioner: %r doesn't contain a version.\n" % (
+        sdistdir.join('PKG-INFO').strpath,)
+
+def test_sdist_with_vcs_args(sdistdir):
+    "Explicit vcs_args are still run in unpacked sdists."
+    version = vcversioner.find_version(Popen=dev_version, vcs_args=['git'])
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    assert sdistdir.join('version.txt').check()
+
+def test_depfile(gitdir, git_metadata):
+    "A dependency file lists the git metadata the version came from."
+    vcversioner.find_version(
+        Popen=basic_version, version_module_paths=['foo.py'], depfile='version.d')
+    assert gitdir.join('version.d').read() == 'version.d: %s %s %s %s\n' % (
+        git_metadata.join('HEAD'),
+        git_metadata.join('refs', 'heads', 'master'),
+        git_metadata.join('refs', 'heads'), git_metadata.join('refs', 'tags'))
+
+def test_depfile_gitfile(tmpdir):
+    "No dependency file is written when .git is a file."
+    tmpdir.chdir()
+    tmpdir.join('.git').write('gitdir: ../spam.git\n')
+    vcversioner.find_version(
+        Popen=basic_version, version_file=None, depfile='version.d')
+    assert not tmpdir.join('version.d').check()
+
+def _git_available():
+    try:
+        subprocess.Popen(
+            ['git', '--version'], stdout=subprocess.PIPE).communicate()
+    except OSError:
+        return False
+    return True
+
+@pytest.mark.skipif(not _git_available(), reason='git is not installed')
+def test_depfile_packed_branch(tmpdir):
+    "Committing to a branch which was packed changes a listed dependency."
+    tmpdir.chdir()
+    def git(*args):
+        subprocess.check_call(
+            # without a reflog, only the refs themselves change.
+            ['git', '-c', 'user.name=spam', '-c', 'user.email=spam@spam',
+             '-c', 'core.logAllRefUpdates=false'] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    git('init', '-q')
+    tmpdir.join('spam').write('spam')
+    git('add', 'spam')
+    git('commit', '-q', '-m', 'spam')
+    git('tag', 'v1.0')
+    git('pack-refs', '--all')
+    vcversioner.find_version(version_file=None, depfile='version.d')
+    deps = tmpdir.join('version.d').read().split(': ', 1)[1].split()
+    for dep in deps:
+        os.utime(dep, (0, 0))
+    tmpdir.join('spam').write('eggs')
+    git('commit', '-q', '-a', '-m', 'eggs')
+    assert any(os.stat(dep).st_mtime > 0 for dep in deps)
+
+def test_depfile_packed_refs(gitdir, git_metadata):
+    "packed-refs is listed when it exists."
+    git_metadata.join('packed-refs').write('')
+    vcversioner.find_version(Popen=basic_version, version_file=None, depfile='version.d')
+    assert git_metadata.join('packed-refs').strpath in gitdir.join('version.d').read()
+
+def test_depfile_version_file_fallback(gitdir, git_metadata):
+    "If the version came from the version file, it's listed too."
+    gitdir.join('version.txt').write('1.0-0-gbeef')
+    vcversioner.find_version(Popen=empty, depfile='version.d')
+    deps = gitdir.join('version.d').read().split(': ', 1)[1].split()
+    assert gitdir.join('version.txt').strpath in deps
+    assert git_metadata.join('HEAD').strpath in deps
+
+def test_depfile_sdist(sdistdir):
+    "In unpacked sdists, the dependency file is its own target."
+    vcversioner.find_version(Popen=RaisingFakePopen(), depfile='version.d')
+    assert sdistdir.join('version.d').read() == 'version.d: %s\n' % (
+        sdistdir.join('PKG-INFO'),)
+
+def test_depfile_hg(hgdir):
+    "hg's dirstate and tags files are listed."
+    hgdir.join('.hg', 'dirstate').write('')
+    hgdir.join('.hgtags').write('')
+    vcversioner.find_version(Popen=hg_version, version_file=None, depfile='version.d')
+    assert hgdir.join('version.d').read() == 'version.d: %s %s\n' % (
+        hgdir.join('.hg', 'dirstate'), hgdir.join('.hgtags'))
+
+def test_no_depfile_with_override(gitdir):
+    "Overridden versions don't depend on any files."
+    vcversioner.find_version(version_override='1.0-0-gbeef', depfile='version.d')
+    assert not gitdir.join('version.d').check()
+
+def test_no_depfile_without_dependencies(tmpdir):
+    "Backends which can't list their dependencies don't get a dependency file."
+    tmpdir.chdir()
+    vcversioner.find_version(
+        backends=[FakeBackend()], version_file=None, depfile='version.d')
+    assert not tmpdir.join('version.d').check()
+
+def test_depfile_escaping(tmpdir):
+    "Paths in dependency files are escaped."
+    tmpdir.chdir()
+    tmpdir.join('a b$#').write('')
+    vcversioner._write_depfile('out put.d', ['a b$#', 'missing'])
+    assert tmpdir.join('out put.d').read() == 'out\\ put.d: a\\ b$$\\#\n'
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def cache_server(request, tmpdir):
+    if request.param == 'tcp':
+        server = vcversioner.make_cache_server(('127.0.0.1', 0))
+        server.url = 'http://127.0.0.1:%d/spam' % (server.server_address[1],)
+    else:
+        path = tmpdir.join('cache.sock').strpath
+        server = vcversioner.make_cache_server('unix:' + path)
+        server.url = 'unix:' + path
+    server.errors = []
+    server.handle_error = lambda request, address: server.errors.append(address)
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.server_close)
+    request.addfinalizer(server.shutdown)
+    return server
+
+def test_version_cache_miss_and_hit(tmpdir, cache_server):
+    "VCS output is stored in the cache and used on later runs."
+    tmpdir.chdir()
+    backend = FakeBackend('1.0-2-gfeeb', fingerprint='spam')
+    version = vcversioner.find_version(
+        backends=[backend], cache_url=cache_server.url, version_file=None)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    assert backend.describe_calls == 1
+    assert list(cache_server.cache.values()) == [b'1.0-2-gfeeb']
+    version = vcversioner.find_version(
+        backends=[backend], cache_url=cache_server.url, version_file=None)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    assert backend.describe_calls == 1
+    assert not cache_server.errors
+
+def test_version_cache_key(tmpdir, cache_server):
+    "Different fingerprints and parameters get different cache entries."
+    tmpdir.chdir()
+    for fingerprint, strip_prefix in [('spam', 'v'), ('eggs', 'v'), ('spam', 'x')]:
+        vcversioner.find_version(
+            backends=[FakeBackend(fingerprint=fingerprint)], strip_prefix=strip_prefix,
+            cache_url=cache_server.url, version_file=None)
+    assert len(cache_server.cache) == 3
+
+def test_version_cache_without_fingerprint(tmpdir, cache_server):
+    "Backends without a fingerprint don't use the cache."
+    tmpdir.chdir()
+    vcversioner.find_version(
+        backends=[FakeBackend()], cache_url=cache_server.url, version_file=None)
+    assert not cache_server.cache
+
+def test_version_cache_invalid_entry(tmpdir, cache_server):
+    "Unusable cache entries are ignored."
+    tmpdir.chdir()
+    backend = FakeBackend(fingerprint='spam')
+    vcversioner.find_version(
+        backends=[backend], cache_url=cache_server.url, version_file=None)
+    for key in cache_server.cache:
+        cache_server.cache[key] = b'\xff'
+    version = vcversioner.find_version(
+        backends=[backend], cache_url=cache_server.url, version_file=None)
+    assert version == ('1.0', '0', 'gbeef')
+    assert backend.describe_calls == 2
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1:1/', 'http://127.0.0.1:spam/', 'unix:/nonexistent/socket'])
+def test_version_cache_unavailable(tmpdir, url):
+    "If the cache server can't be reached, the VCS is used as usual."
+    tmpdir.chdir()
+    backend = FakeBackend(fingerprint='spam')
+    version = vcversioner.find_version(
+        backends=[backend], cache_url=url, version_file=None)
+    assert version == ('1.0', '0', 'gbeef')
+    assert backend.describe_calls == 1
+
+def test_version_cache_timeout(tmpdir):
+    "A cache server which never responds is given up on."
+    tmpdir.chdir()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    try:
+        backend = FakeBackend(fingerprint='spam')
+        version = vcversioner.find_version(
+            backends=[backend], version_file=None, cache_timeout=0.01,
+            cache_url='http://127.0.0.1:%d/' % (listener.getsockname()[1],))
+    finally:
+        listener.close()
+    assert version == ('1.0', '0', 'gbeef')
+    assert backend.describe_calls == 1
+
+def test_main_cache_server(monkeypatch):
+    "``python -m vcversioner cache-server`` runs the reference server."
+    addresses = []
+    class FakeServer(object):
+        def serve_forever(self):
+            pass
+    def make_cache_server(address):
+        addresses.append(address)
+        return FakeServer()
+    monkeypatch.setattr(vcversioner, 'make_cache_server', make_cache_server)
+    vcversioner.main(['cache-server'])
+    vcversioner.main(['cache-server', '0.0.0.0:1234'])
+    vcversioner.main(['cache-server', 'unix:/spam'])
+    assert addresses == [('localhost', 8642), ('0.0.0.0', 1234), 'unix:/spam']
+
+
+class StreamingFakePopen(object):
+    "A process whose output can be read incrementally."
+    def __init__(self, stdout, stderr=b'', returncode=0):
+        self.stdout = io.BytesIO(stdout)
+        self.stderr = stderr
+        self.waited = False
+        self._returncode = returncode
+        self.returncode = None
+
+    def wait(self):
+        self.waited = True
+        self.returncode = self._returncode
+        return self.returncode
+
+class HistoryFakePopen(object):
+    """Fake the git commands run to walk a history.
+
+    *describe* maps each commit to what describing it outputs.
+    """
+    def __init__(self, log, tags=b'', describe=None):
+        self.log = StreamingFakePopen(log)
+        self.outputs = {
+            'for-each-ref': FakePopen(tags),
+            'describe': FakePopen(b'', b'fatal: No names found', returncode=128),
+        }
+        self.describe = describe or {}
+        self.calls = []
+
+    def __call__(self, args, **kwargs):
+        self.calls.append(args)
+        if 'log' in args:
+            kwargs['stderr'].write(self.log.stderr)
+            return self.log
+        if 'describe' in args and args[-1] in self.describe:
+            return FakePopen(self.describe[args[-1]])
+        for arg in args:
+            if arg in self.outputs:
+                return self.outputs[arg]
+        raise OSError('no such command')
+
+history_log = (
+    b'1111 11 \n'
+    b'2222 22 1111\n'
+    b'3333 33 2222\n'
+    b'9999 99 2222\n'
+    b'4444 44 3333 9999\n'
+    b'5555 55 4444\n')
+history_tags = (
+    b'2222  refs/tags/v1.0\n'
+    b'aaaa 4444 refs/tags/spam-2.0\n'
+    b'bbbb 4444 refs/tags/v1.1\n')
+
+def test_iter_versions(tmpdir):
+    "Every commit after the first tag gets a version."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(
+        history_log, history_tags, describe={'9999': b'v1.0-1-g99\n'})
+    versions = list(vcversioner.iter_versions(Popen=popen))
+    assert versions == [
+        ('2222', ('1.0', '0', 'g22')),
+        ('3333', ('1.0.post1', '1', 'g33')),
+        ('9999', ('1.0.post1', '1', 'g99')),
+        ('4444', ('spam-2.0', '0', 'g44')),
+        ('5555', ('spam-2.0.post1', '1', 'g55')),
+    ]
+    assert popen.log.waited
+    assert popen.calls[1] == [
+        'git', '--git-dir', tmpdir.join('.git').strpath, 'log',
+        '--topo-order', '--reverse', '--format=%H %h %P', 'HEAD']
+
+def test_iter_versions_match_prefix(tmpdir):
+    "Tags can be restricted to ones starting with the stripped prefix."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(
+        history_log, history_tags, describe={'9999': b'v1.0-1-g99\n'})
+    versions = list(vcversioner.iter_versions(
+        Popen=popen, match_prefix=True, include_dev_version=False))
+    assert [version for commit, version in versions] == [
+        ('1.0', '0', 'g22'), ('1.0', '1', 'g33'), ('1.0', '1', 'g99'),
+        ('1.1', '0', 'g44'), ('1.1', '1', 'g55')]
+    assert popen.calls[2][3:] == [
+        'describe', '--tags', '--long', '--match', 'v*', '9999']
+
+def test_iter_versions_untagged_merge(tmpdir):
+    "Merges are described again, and side branches are walked too."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(
+        b'1111 11 \n'
+        b'2222 22 1111\n'
+        b'3333 33 2222\n'
+        b'9999 99 2222\n'
+        b'8888 88 9999\n'
+        b'4444 44 3333 8888\n'
+        b'5555 55 4444\n',
+        b'2222  refs/tags/v1.0\n',
+        describe={'9999': b'v1.0-1-g99\n', '4444': b'v1.0-4-g44\n'})
+    versions = list(vcversioner.iter_versions(Popen=popen))
+    assert versions == [
+        ('2222', ('1.0', '0', 'g22')),
+        ('3333', ('1.0.post1', '1', 'g33')),
+        ('9999', ('1.0.post1', '1', 'g99')),
+        ('8888', ('1.0.post2', '2', 'g88')),
+        ('4444', ('1.0.post4', '4', 'g44')),
+        ('5555', ('1.0.post5', '5', 'g55')),
+    ]
+    assert [args[-1] for args in popen.calls if 'describe' in args] == [
+        '9999', '4444']
+
+@pytest.mark.skipif(not _git_available(), reason='git is not installed')
+def test_iter_versions_matches_describe(tmpdir):
+    "Every commit in a merged history gets the version git describe gives."
+    tmpdir.chdir()
+    def git(*args):
+        return subprocess.Popen(
+            ['git', '-c', 'user.name=spam', '-c', 'user.email=spam@spam']
+            + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        ).communicate()[0].decode().strip()
+    def commit(message):
+        git('commit', '-q', '--allow-empty', '-m', message)
+    git('init', '-q')
+    commit('spam')
+    git('tag', 'v1.0')
+    git('checkout', '-q', '-b', 'side')
+    commit('eggs')
+    commit('ham')
+    git('checkout', '-q', '-')
+    commit('bacon')
+    git('merge', '-q', '--no-ff', '-m', 'merge', 'side')
+    commit('beans')
+    versions = list(vcversioner.iter_versions())
+    assert len(versions) == 6
+    for sha, version in versions:
+        raw_version = git('describe', '--tags', '--long', sha)
+        tag, commits, abbrev = raw_version.rsplit('-', 2)
+        assert (version.commits, version.sha) == (commits, abbrev)
+
+def test_iter_versions_partial_range(tmpdir):
+    "A range starting after a tag finds that tag first."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(
+        history_log.split(b'\n', 2)[2], history_tags,
+        describe={'3333': b'v1.0-1-g33\n', '9999': b'v1.0-1-g99\n'})
+    versions = list(vcversioner.iter_versions('2222..', Popen=popen))
+    assert versions[0] == ('3333', ('1.0.post1', '1', 'g33'))
+    assert popen.calls[2][3:] == ['describe', '--tags', '--long', '3333']
+
+def test_iter_versions_partial_range_untagged(tmpdir):
+    "Commits with no tag before them are skipped."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(history_log.split(b'\n', 2)[2])
+    assert list(vcversioner.iter_versions('2222..', Popen=popen)) == []
+
+def test_iter_versions_invalid_range(tmpdir, capsys):
+    "If git can't walk the range, the failure is reported."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(b'')
+    popen.log = StreamingFakePopen(
+        b'', b"fatal: bad revision 'spam..HEAD'\n", returncode=128)
+    with pytest.raises(SystemExit) as excinfo:
+        list(vcversioner.iter_versions('spam..HEAD', Popen=popen))
+    assert excinfo.value.args[0] == 2
+    out, err = capsys.readouterr()
+    assert out.endswith(
+        "'spam..HEAD'] failed.\n"
+        "vcversioner: -- VCS output follows --\n"
+        "vcversioner: fatal: bad revision 'spam..HEAD'\n")
+
+def test_iter_versions_describe_garbled(tmpdir, capsys):
+    "describe output which can't be parsed is reported."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(
+        history_log.split(b'\n', 2)[2], history_tags,
+        describe={'3333': b'v1.0\n'})
+    with pytest.raises(SystemExit):
+        list(vcversioner.iter_versions('2222..', Popen=popen))
+    out, err = capsys.readouterr()
+    assert "'describe', '--tags', '--long', '3333'] failed." in out
+
+def test_iter_versions_closed_early(tmpdir):
+    "The git process is cleaned up when iteration stops early."
+    tmpdir.chdir()
+    popen = HistoryFakePopen(history_log, history_tags)
+    versions = vcversioner.iter_versions(Popen=popen)
+    next(versions)
+    versions.close()
+    assert popen.log.waited
+    assert popen.log.stdout.closed
+
+def tags_note(gitdir, raw_version):
+    digest = vcversioner._tags_digest(gitdir.join('.git').strpath)
+    return ('%s\n\ntags %s\n' % (raw_version, digest)).encode()
+
+def test_notes_miss(gitdir):
+    "Without a saved note, the VCS output is saved as one."
+    popen = CommandFakePopen(
+        show=FakePopen(b'', b'error: no note found', returncode=1),
+        describe=dev_version, add=FakePopen(b''))
+    version = vcversioner.find_version(notes_ref='vcversioner', Popen=popen)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    git = ['git', '--git-dir', gitdir.join('.git').strpath, 'notes', '--ref', 'vcversioner']
+    assert [args for args, kwargs in popen.calls] == [
+        git + ['show', 'HEAD'],
+        ['git', '--git-dir', gitdir.join('.git').strpath, 'describe', '--tags', '--long'],
+        ['git', '-c', 'user.name=vcversioner',
+         '-c', 'user.email=vcversioner@localhost'] + git[1:] + [
+             'add', '-f', '-m', '1.0-2-gfeeb', '-m',
+             'tags ' + vcversioner._tags_digest(gitdir.join('.git').strpath),
+             'HEAD'],
+    ]
+
+@pytest.mark.skipif(not _git_available(), reason='git is not installed')
+def test_notes_without_identity(tmpdir):
+    "Notes are saved even when git has no identity to commit them as."
+    tmpdir.chdir()
+    def git(*args):
+        return subprocess.Popen(
+            ['git'] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        ).communicate()[0].decode().strip()
+    git('init', '-q')
+    git('-c', 'user.name=spam', '-c', 'user.email=spam@spam',
+        'commit', '-q', '--allow-empty', '-m', 'spam')
+    git('tag', 'v1.0')
+    # don't let git guess an identity from the environment.
+    git('config', 'user.useConfigOnly', 'true')
+    version = vcversioner.find_version(
+        notes_ref='vcversioner', version_file=None)
+    assert version == ('1.0', '0', 'g' + git('rev-parse', '--short', 'HEAD'))
+    assert git('notes', '--ref', 'vcversioner', 'show', 'HEAD').startswith(
+        'v1.0-0-g')
+
+def test_notes_hit(gitdir):
+    "A saved note is used instead of running the VCS."
+    popen = CommandFakePopen(show=FakePopen(tags_note(gitdir, '1.0-3-gfeeb')))
+    version = vcversioner.find_version(notes_ref='vcversioner', Popen=popen)
+    assert version == ('1.0.post3', '3', 'gfeeb')
+    assert len(popen.calls) == 1
+
+def test_notes_stale_after_tagging(gitdir, git_metadata):
+    "Adding a tag makes notes saved before it be ignored and replaced."
+    note = tags_note(gitdir, '1.0-3-gfeeb')
+    git_metadata.join('refs', 'tags', 'v1.1').write('a' * 40 + '\n')
+    popen = CommandFakePopen(
+        show=FakePopen(note), describe=FakePopen(b'v1.1-0-gfeeb'),
+        add=FakePopen(b''))
+    version = vcversioner.find_version(notes_ref='vcversioner', Popen=popen)
+    assert version == ('1.1', '0', 'gfeeb')
+    add_args, add_kwargs = popen.calls[-1]
+    assert add_args[-2:] == [
+        'tags ' + vcversioner._tags_digest(git_metadata.strpath), 'HEAD']
+    assert tags_note(gitdir, '1.0-3-gfeeb') != note
+
+@pytest.mark.parametrize('note', [b'spam\n', b'1.0-3-gfeeb\n'])
+def test_notes_invalid(gitdir, note):
+    "Unusable notes, or ones without a digest of the tags, are ignored."
+    popen = CommandFakePopen(
+        show=FakePopen(note), describe=dev_version, add=FakePopen(b''))
+    version = vcversioner.find_version(notes_ref='vcversioner', Popen=popen)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    assert len(popen.calls) == 3
+
+def test_notes_not_used_by_default(gitdir):
+    "Notes are only used when asked for."
+    popen = CommandFakePopen(show=FakePopen(b'1.0-3-gfeeb\n'), describe=dev_version)
+    vcversioner.find_version(Popen=popen)
+    assert len(popen.calls) == 1
+
+def test_notes_ignored_with_version_path(gitdir, git_metadata, spamdir):
+    "Notes aren't used when versioning only part of a repository."
+    popen = ScopedGitFakePopen()
+    vcversioner.find_version(
+        notes_ref='vcversioner', version_path='spam', Popen=popen)
+    assert not any('notes' in args for args in popen.calls)
+
+def test_notes_unsupported(hgdir):
+    "Backends which can't save versions run the VCS as usual."
+    version = vcversioner.find_version(notes_ref='vcversioner', Popen=hg_version)
+    assert version == ('1.0', '0', 'hgbeef')
+
+def test_version_outputs(gitdir):
+    "Version files for other languages can be generated too."
+    vcversioner.find_version(Popen=dev_version, version_outputs=[
+        ('version.h', 'c'), ('version.sh', 'shell'), ('version.json', 'json'),
+        ('%(root)s/_version.py', 'python')])
+    assert gitdir.join('version.h').read() == """/* This file is automatically generated by setup.py. */
+#ifndef VCVERSIONER_VERSION_H
+#define VCVERSIONER_VERSION_H
+#define VCVERSIONER_VERSION "1.0.post2"
+#define VCVERSIONER_VERSION_COMMITS 2
+#define VCVERSIONER_VERSION_SHA "gfeeb"
+#endif
+"""
+    assert gitdir.join('version.sh').read() == """# This file is automatically generated by setup.py.
+VCVERSIONER_VERSION='1.0.post2'
+VCVERSIONER_VERSION_COMMITS='2'
+VCVERSIONER_VERSION_SHA='gfeeb'
+"""
+    assert json.loads(gitdir.join('version.json').read()) == {
+        'version': '1.0.post2', 'commits': '2', 'sha': 'gfeeb', 'dirty': False}
+    assert "__version__ = '1.0.post2'" in gitdir.join('_version.py').read()
+
+def test_version_outputs_c_header_names(gitdir):
+    "C header guards come from the whole path, and macros can be prefixed."
+    gitdir.join('spam').mkdir()
+    vcversioner.find_version(
+        Popen=basic_version, c_macro_prefix='SPAM_',
+        version_outputs=[('version.h', 'c'), ('%(root)s/spam/version.h', 'c')])
+    assert gitdir.join('version.h').read().splitlines()[1:4] == [
+        '#ifndef SPAM_VERSION_H', '#define SPAM_VERSION_H',
+        '#define SPAM_VERSION "1.0"']
+    assert gitdir.join('spam', 'version.h').read().splitlines()[1:3] == [
+        '#ifndef SPAM_SPAM_VERSION_H', '#define SPAM_SPAM_VERSION_H']
+
+def test_version_outputs_shell_names(gitdir):
+    "Shell variables can be prefixed."
+    vcversioner.find_version(
+        Popen=basic_version, shell_var_prefix='SPAM_',
+        version_outputs=[('version.sh', 'shell')])
+    assert gitdir.join('version.sh').read().splitlines()[1:] == [
+        "SPAM_VERSION='1.0'", "SPAM_VERSION_COMMITS='0'",
+        "SPAM_VERSION_SHA='gbeef'"]
+
+def test_version_outputs_quoting(gitdir):
+    "Strings in version files are quoted properly."
+    vcversioner.find_version(
+        Popen=FakePopen(b'it\'s"\\-0-gbeef'),
+        version_outputs=[('version.h', 'c'), ('version.sh', 'shell')])
+    assert '#define VCVERSIONER_VERSION "it\'s\\"\\\\"\n' in gitdir.join('version.h').read()
+    assert "VCVERSIONER_VERSION='it'\\''s\"\\'\n" in gitdir.join('version.sh').read()
+
+def test_version_outputs_unchanged(gitdir):
+    "Version files which wouldn't change aren't rewritten."
+    vcversioner.find_version(Popen=basic_version, version_outputs=[('version.h', 'c')])
+    gitdir.join('version.h').setmtime(1)
+    vcversioner.find_version(Popen=basic_version, version_outputs=[('version.h', 'c')])
+    assert gitdir.join('version.h').mtime() == 1
+
+def test_version_outputs_unknown_format(gitdir, capsys):
+    "Unknown formats are rejected before doing anything else."
+    popen = RaisingFakePopen()
+    with pytest.raises(SystemExit) as excinfo:
+        vcversioner.find_version(Popen=popen, version_outputs=[('version.x', 'spam')])
+    assert excinfo.value.args[0] == 2
+    assert not hasattr(popen, 'args')
+    out, err = capsys.readouterr()
+    assert out == "vcversioner: %r has an unknown output format %r.\n" % ('version.x', 'spam')
+
+def test_version_outputs_depfile(gitdir, git_metadata):
+    "The dependency file is rewritten every run, but unchanged outputs aren't."
+    kwargs = dict(
+        Popen=basic_version, depfile='version.d',
+        version_outputs=[('version.h', 'c')])
+    vcversioner.find_version(**kwargs)
+    for name in ['version.d', 'version.h', 'version.txt']:
+        os.utime(gitdir.join(name).strpath, (0, 0))
+    vcversioner.find_version(**kwargs)
+    assert gitdir.join('version.d').read().startswith('version.d: ')
+    assert gitdir.join('version.d').mtime() > 0
+    assert gitdir.join('version.h').mtime() == 0
+    assert gitdir.join('version.txt').mtime() == 0
+
+
+class SimulatedProcess(object):
+    def __init__(self, vcs, args):
+        self.vcs = vcs
+        self.args = args
+        self.returncode = None
+        self.killed = False
+
+    def kill(self):
+        with self.vcs.changed:
+            self.vcs.kills += 1
+            self.killed = True
+            self.vcs.changed.notify_all()
+
+    def communicate(self):
+        vcs = self.vcs
+        with vcs.changed:
+            vcs.active += 1
+            vcs.max_active = max(vcs.max_active, vcs.active)
+            vcs.changed.notify_all()
+            while not (vcs.released or self.killed):
+                vcs.changed.wait()
+            vcs.active -= 1
+        if self.killed:
+            # a killed process only got part of its output out.
+            self.returncode = -9
+            return vcs.stdout[:len(vcs.stdout) // 2], vcs.stderr[:len(vcs.stderr) // 2]
+        self.returncode = vcs.returncode
+        return vcs.stdout, vcs.stderr
+
+class SimulatedVCS(object):
+    """A configurable stand-in for VCS programs, passed as ``Popen``.
+
+    Every process spawned produces *stdout*, *stderr*, and *returncode*. If
+    *hang* is true, processes don't finish until ``release()`` is called or
+    they're killed, and ``wait_for_active()`` waits for some number of them
+    to be waited on at once. Killed processes produce half of their output.
+    If *spawn_error* is given, it's raised instead of spawning anything.
+    """
+
+    def __init__(self, stdout=b'1.0-0-gbeef', stderr=b'', returncode=0,
+                 hang=False, spawn_error=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.released = not hang
+        self.spawn_error = spawn_error
+        self.changed = threading.Condition()
+        self.calls = []
+        self.active = self.max_active = self.kills = 0
+
+    def __call__(self, args, **kwargs):
+        with self.changed:
+            self.calls.append(args)
+        if self.spawn_error is not None:
+            raise self.spawn_error
+        return SimulatedProcess(self, args)
+
+    def release(self):
+        with self.changed:
+            self.released = True
+            self.changed.notify_all()
+
+    def wait_for_active(self, count):
+        with self.changed:
+            while self.active < count:
+                self.changed.wait()
+
+
+class SimulatedFile(object):
+    def __init__(self, fs, path, infile):
+        self.fs = fs
+        self.path = path
+        self.infile = infile
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.infile.close()
+
+    def __getattr__(self, attr):
+        return getattr(self.infile, attr)
+
+    def write(self, data):
+        # write in two halves with a pause between, so that concurrent
+        # readers can observe a partially-written file.
+        half = len(data) // 2
+        self.infile.write(data[:half])
+        self.infile.flush()
+        time.sleep(self.fs.write_delay)
+        self.infile.write(data[half:])
+
+class SimulatedFilesystem(object):
+    """A stand-in for ``open`` which can be slow, fail, or be locked.
+
+    Opening a path in *read_errors* or *write_errors* for reading or writing
+    respectively raises the exception given for it. Writes are split in two,
+    with *write_delay* seconds between the halves. While the lock from
+    ``locked()`` is held, opening files for writing blocks, and the
+    ``blocked`` event is set once something does.
+    """
+
+    def __init__(self, read_errors=None, write_errors=None, write_delay=0):
+        self.read_errors = read_errors or {}
+        self.write_errors = write_errors or {}
+        self.write_delay = write_delay
+        self.write_lock = threading.Lock()
+        self.blocked = threading.Event()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.write_lock:
+            yield
+
+    def __call__(self, path, mode='r'):
+        writing = 'w' in mode
+        with self.lock:
+            self.opened.append((path, mode))
+        errors = self.write_errors if writing else self.read_errors
+        if path in errors:
+            raise errors[path]
+        if writing:
+            if not self.write_lock.acquire(False):
+                self.blocked.set()
+                self.write_lock.acquire()
+            self.write_lock.release()
+        return SimulatedFile(self, path, io.open(path, mode))
+
+
+def test_simulated_hung_vcs_timeout(gitdir):
+    "A hung VCS is killed after the timeout and the version file is used."
+    gitdir.join('version.txt').write('1.0-0-gbeef')
+    vcs = SimulatedVCS(stdout=b'2.0-0-gfeeb', hang=True)
+    version = vcversioner.find_version(Popen=vcs, vcs_timeout=0.01)
+    assert version == ('1.0', '0', 'gbeef')
+    assert vcs.kills == 1
+
+def test_simulated_hung_vcs_no_version_file(gitdir):
+    "A hung VCS with no version file to fall back on aborts after the timeout."
+    vcs = SimulatedVCS(hang=True)
+    with pytest.raises(SystemExit) as excinfo:
+        vcversioner.find_version(Popen=vcs, vcs_timeout=0.01)
+    assert excinfo.value.args[0] == 2
+    assert vcs.kills == 1
+
+def test_simulated_vcs_within_timeout(gitdir):
+    "A VCS finishing within the timeout is used as usual."
+    vcs = SimulatedVCS(stdout=b'2.0-0-gfeeb')
+    version = vcversioner.find_version(Popen=vcs, vcs_timeout=60)
+    assert version == ('2.0', '0', 'gfeeb')
+    assert vcs.kills == 0
+
+def test_simulated_hung_dirty_check(gitdir):
+    "A dirty check which times out leaves the working tree treated as clean."
+    describe = SimulatedVCS(stdout=b'1.0-2-gfeeb')
+    status = SimulatedVCS(stdout=b' M spam.py\n', hang=True)
+    popen = CommandFakePopen(describe=describe, status=status)
+    # long enough that describe is never killed, even on a loaded machine.
+    version = vcversioner.find_version(
+        Popen=popen, check_dirty=True, vcs_timeout=0.5)
+    assert version == ('1.0.post2', '2', 'gfeeb')
+    assert not version.dirty
+    assert (describe.kills, status.kills) == (0, 1)
+
+def test_simulated_crash_with_partial_output(gitdir, capsys):
+    "A VCS which crashes partway through its output aborts."
+    vcs = SimulatedVCS(stdout=b'2.0-', stderr=b'segfault', returncode=-11)
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(Popen=vcs)
+    out, err = capsys.readouterr()
+    assert "'2.0-' (from VCS) couldn't be parsed" in out
+    assert out.endswith('vcversioner: segfault\n')
+
+def test_simulated_spawn_error(gitdir):
+    "A VCS which can't be spawned falls back on the version file."
+    gitdir.join('version.txt').write('1.0-0-gbeef')
+    vcs = SimulatedVCS(spawn_error=OSError(errno.ENOENT, 'no such file'))
+    version = vcversioner.find_version(Popen=vcs, vcs_timeout=60)
+    assert version == ('1.0', '0', 'gbeef')
+
+def test_simulated_huge_stderr(gitdir, capsys):
+    "Huge amounts of VCS output on stderr are handled."
+    vcs = SimulatedVCS(stderr=b'warning: ' + b'x' * (8 * 1024 * 1024) + b'\n')
+    version = vcversioner.find_version(Popen=vcs)
+    assert version == ('1.0', '0', 'gbeef')
+    out, err = capsys.readouterr()
+    assert not out
+
+def test_simulated_huge_stderr_on_failure(gitdir, capsys):
+    "Huge VCS output is shown in full when the VCS fails."
+    lines = [('error: %d' % (i,)).encode() for i in range(10000)]
+    vcs = SimulatedVCS(stdout=b'', stderr=b'\n'.join(lines), returncode=128)
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(Popen=vcs, version_file=None)
+    out, err = capsys.readouterr()
+    assert out.count('\n') == len(lines) + 2
+
+def test_simulated_stamp_versions_slow_vcs(tmpdir):
+    "Bulk stamping only waits on a slow VCS once."
+    tmpdir.chdir()
+    tmpdir.join('.git').mkdir()
+    vcs = SimulatedVCS(stdout=b'1.0-2-gfeeb', hang=True)
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(
+        vcversioner.stamp_versions(
+            [{'version_module_paths': ['mod%d.py' % (i,)]} for i in range(20)],
+            Popen=vcs)))
+    thread.start()
+    vcs.wait_for_active(1)
+    vcs.release()
+    thread.join()
+    assert set(results) == set([('1.0.post2', '2', 'gfeeb')])
+    assert len(results) == 20
+    assert len(vcs.calls) == 1
+
+def test_simulated_stamp_versions_hung_vcs(tmpdir):
+    "Bulk stamping only waits for a hung VCS to time out once."
+    tmpdir.chdir()
+    tmpdir.join('.git').mkdir()
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    vcs = SimulatedVCS(hang=True)
+    versions = vcversioner.stamp_versions([{}] * 10, Popen=vcs, vcs_timeout=0.01)
+    assert versions == [('1.0', '0', 'gbeef')] * 10
+    assert (len(vcs.calls), vcs.kills) == (1, 1)
+
+def test_simulated_stamp_versions_hung_vcs_project_timeout(tmpdir):
+    "A project's own timeout kills a hung VCS shared with later projects."
+    tmpdir.chdir()
+    tmpdir.join('.git').mkdir()
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    vcs = SimulatedVCS(hang=True)
+    versions = vcversioner.stamp_versions(
+        [{'vcs_timeout': 0.01}] + [{}] * 9, Popen=vcs)
+    assert versions == [('1.0', '0', 'gbeef')] * 10
+    assert (len(vcs.calls), vcs.kills) == (1, 1)
+
+def test_simulated_concurrent_callers(gitdir):
+    "Concurrent callers get the same version and leave a consistent version file."
+    vcs = SimulatedVCS(stdout=b'1.0-2-gfeeb', hang=True)
+    fs = SimulatedFilesystem(write_delay=0.01)
+    results = []
+    def run():
+        results.append(vcversioner.find_version(
+            Popen=vcs, open=fs, version_module_paths=['foo.py']))
+    threads = [threading.Thread(target=run) for x in range(8)]
+    for thread in threads:
+        thread.start()
+    # every caller is waiting on the VCS at once before any of them finish.
+    vcs.wait_for_active(8)
+    vcs.release()
+    for thread in threads:
+        thread.join()
+    assert results == [('1.0.post2', '2', 'gfeeb')] * 8
+    assert vcs.max_active == 8
+    assert gitdir.join('version.txt').read() == '1.0-2-gfeeb'
+    assert "'1.0.post2'" in gitdir.join('foo.py').read()
+
+def test_simulated_racing_version_file_writer(gitdir):
+    "A concurrent writer of the version file doesn't affect the VCS version."
+    fs = SimulatedFilesystem(write_delay=0.005)
+    version_file = gitdir.join('version.txt').strpath
+    stop = threading.Event()
+    def write_stale():
+        while not stop.is_set():
+            with fs(version_file, 'w') as outfile:
+                outfile.write('0.9-0-gdead')
+    writer = threading.Thread(target=write_stale)
+    writer.start()
+    try:
+        versions = [
+            vcversioner.find_version(Popen=SimulatedVCS(b'1.0-2-gfeeb'), open=fs)
+            for x in range(10)]
+    finally:
+        stop.set()
+        writer.join()
+    assert versions == [('1.0.post2', '2', 'gfeeb')] * 10
+    vcversioner.find_version(Popen=SimulatedVCS(b'1.0-2-gfeeb'), open=fs)
+    assert gitdir.join('version.txt').read() == '1.0-2-gfeeb'
+
+def test_simulated_write_lock_contention(gitdir):
+    "Writes blocked on a lock complete once the lock is released."
+    fs = SimulatedFilesystem()
+    results = []
+    with fs.locked():
+        thread = threading.Thread(target=lambda: results.append(
+            vcversioner.find_version(Popen=SimulatedVCS(), open=fs)))
+        thread.start()
+        fs.blocked.wait()
+        assert not results
+    thread.join()
+    assert results == [('1.0', '0', 'gbeef')]
+
+def test_simulated_unreadable_output(gitdir):
+    "Files which can't be read to compare against are rewritten."
+    gitdir.join('foo.py').write('stale')
+    fs = SimulatedFilesystem(read_errors={
+        'foo.py': IOError(errno.EACCES, 'permission denied')})
+    vcversioner.find_version(Popen=SimulatedVCS(), open=fs, version_module_paths=['foo.py'])
+    assert "'1.0'" in gitdir.join('foo.py').read()
+
+def test_simulated_unwritable_version_file(gitdir):
+    "Failing to write the version file is an error."
+    fs = SimulatedFilesystem(write_errors={
+        gitdir.join('version.txt').strpath: IOError(errno.ENOSPC, 'no space left')})
+    with pytest.raises(IOError):
+        vcversioner.find_version(Popen=SimulatedVCS(), open=fs)
@@ -22,12 +22,33 @@ Code online: https://github.com/habnabit/vcversioner
 from __future__ import print_function, unicode_literals
 
 import collections
+import hashlib
+import json
 import os
+import re
 import subprocess
+import sys
+import tempfile
+import threading
+import timeit
 import warnings
 
 
-Version = collections.namedtuple('Version', 'version commits sha')
+class Version(collections.namedtuple('Version', 'version commits sha')):
+    """A version found by :func:`find_version`.
+
+    Besides the tuple fields, *dirty* is true if the working tree was checked
+    for uncommitted changes and some were found. It isn't part of the tuple,
+    so comparisons with plain tuples still work.
+
+    """
+
+    dirty = False
+
+    def __new__(cls, version, commits, sha, dirty=False):
+        self = super(Version, cls).__new__(cls, version, commits, sha)
+        self.dirty = dirty
+        return self
 
 
 _print = print
@@ -40,19 +61,800 @@ def _fix_path(p):
     return p.replace('/', os.sep)
 
 
-_vcs_args_by_path = [
-    ('%(root)s/.git', (
-        'git', '--git-dir', '%(root)s/.git', 'describe', '--tags', '--long')),
-    ('%(root)s/.hg', (
+def _write_if_changed(path, content, open=open):
+    """Write *content* to *path*, unless *path* already contains exactly that.
+
+    Returns whether the file was written. Leaving unchanged files alone keeps
+    their mtimes stable, so build tools don't rebuild everything downstream of
+    them.
+
+    """
+
+    try:
+        with open(path, 'r') as infile:
+            if infile.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    with open(path, 'w') as outfile:
+        outfile.write(content)
+    return True
+
+
+def _literal(s):
+    "Render *s* as a python string literal, without any ``u`` prefix."
+    return repr(s).lstrip('u')
+
+
+_version_module_template = """
+# This file is automatically generated by setup.py.
+__version__ = {version}
+__sha__ = {sha}
+__revision__ = {sha}
+"""
+
+
+class Backend(object):
+    """A way of asking some VCS for a version.
+
+    :func:`find_version` tries each backend returned by :func:`get_backends` in
+    turn, and uses the first one whose :meth:`detect` returns true. Backends
+    can be added by subclassing this class and either passing an instance to
+    :func:`register_backend` or advertising it with a ``vcversioner.backends``
+    entry point.
+
+    Each method is passed *substitute*, a function which performs the standard
+    substitutions (``%(root)s`` and ``%(pwd)s``) on a string.
+
+    """
+
+    #: A short name identifying the backend, e.g. ``'git'``.
+    name = None
+
+    def detect(self, substitute):
+        """Return whether this backend applies to the project root."""
+        raise NotImplementedError()
+
+    def describe(self, substitute, Popen):
+        """Describe the current revision.
+
+        Returns a tuple of the raw version string, in the
+        ``<tag>-<commits>-<revision>`` format, and a list of lines of output to
+        show if the raw version turns out to be unusable. An empty raw version
+        means the VCS failed. ``OSError`` can be raised if the VCS couldn't be
+        run at all. *Popen* should be used for running any programs.
+
+        """
+
+        raise NotImplementedError()
+
+    def describe_scoped(self, substitute, Popen, path=None, tag_prefix=None):
+        """Describe the current revision, as seen by part of the repository.
+
+        This is like :meth:`describe`, except that if *path* is given, only
+        the revisions which touched *path* are counted, and the revision
+        reported is the most recent one which touched *path*. The tag is
+        still the one the current revision would be described with, and if
+        that tag is newer than any change to *path*, no revisions are
+        counted. If *tag_prefix* is given, only tags starting with it are
+        considered. Backends which don't support this raise
+        ``NotImplementedError``.
+
+        """
+
+        if path is None and tag_prefix is None:
+            return self.describe(substitute, Popen)
+        raise NotImplementedError()
+
+    def read_note(self, substitute, ref, Popen):
+        """Read a raw version saved by :meth:`write_note`.
+
+        Returns the raw version saved for the current revision under the notes
+        ref *ref*, or ``None`` if there isn't one, or if this backend doesn't
+        support saving versions.
+
+        """
+
+        return None
+
+    def write_note(self, substitute, ref, raw_version, Popen):
+        """Save a raw version for the current revision under notes ref *ref*.
+
+        Backends which don't support saving versions do nothing.
+
+        """
+
+    def start_dirty_check(self, substitute, paths, Popen):
+        """Start checking the working tree for uncommitted changes.
+
+        *paths* is a list of paths to restrict the check to, or ``None`` to
+        check the whole working tree. Returns ``None`` if this backend can't
+        check for changes, or otherwise a function which takes no arguments
+        and returns whether there were changes. The check is split in two like
+        this so that it can run concurrently with :meth:`describe`.
+
+        """
+
+        return None
+
+    def dependencies(self, substitute):
+        """List the files :meth:`describe` depends on.
+
+        Returns a list of paths which, if none of them changed, mean the
+        description won't have changed either, or ``None`` if there's no such
+        list. Paths which don't exist are fine to include. This is used for
+        writing dependency files for build tools.
+
+        """
+
+        return None
+
+    def fingerprint(self, substitute):
+        """Cheaply identify the repository state :meth:`describe` depends on.
+
+        Returns a string, or ``None`` if the state can't be identified without
+        doing as much work as :meth:`describe` does. Any two calls returning
+        the same string must have the same description, which lets the result
+        of :meth:`describe` be cached.
+
+        """
+
+        return None
+
+    def display(self, substitute):
+        """Return how to refer to this backend in error messages."""
+        return repr(self.name)
+
+
+class CommandBackend(Backend):
+    """A backend which runs a command to describe the current revision.
+
+    The backend is detected by the presence of *metadata_path*, and runs
+    *args*. Standard substitutions are performed on both. If *dirty_args* is
+    given, it's the command used to check for uncommitted changes, run from
+    the project root with any paths to check appended. Any output from it
+    means there are changes. If *dependency_paths* is given, it's the list of
+    files returned by :meth:`~Backend.dependencies`, after substitutions.
+
+    """
+
+    def __init__(self, name, metadata_path, args, dirty_args=None,
+                 dependency_paths=None):
+        self.name = name
+        self.metadata_path = metadata_path
+        self.args = args
+        self.dirty_args = dirty_args
+        self.dependency_paths = dependency_paths
+
+    def detect(self, substitute):
+        if self.metadata_path is None:
+            return False
+        return os.path.exists(substitute(self.metadata_path))
+
+    def command(self, substitute):
+        return [substitute(arg) for arg in self.args]
+
+    def describe(self, substitute, Popen):
+        proc = Popen(
+            self.command(substitute),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        return stdout.strip().decode(), stderr.decode().splitlines()
+
+    def start_dirty_check(self, substitute, paths, Popen):
+        if self.dirty_args is None:
+            return None
+        args = [substitute(arg) for arg in self.dirty_args]
+        if paths is not None:
+            args.append('--')
+            args.extend(substitute(path) for path in paths)
+        proc = Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=substitute('%(root)s'))
+        def finish():
+            stdout, stderr = proc.communicate()
+            return proc.returncode == 0 and bool(stdout.strip())
+        return finish
+
+    def dependencies(self, substitute):
+        if self.dependency_paths is None:
+            return None
+        return [substitute(path) for path in self.dependency_paths]
+
+    def display(self, substitute):
+        return repr(self.command(substitute))
+
+
+def _read_packed_refs(git_dir):
+    "Parse a ``packed-refs`` file into a dict of ref names to values."
+    refs = {}
+    try:
+        infile = open(os.path.join(git_dir, 'packed-refs'), 'rb')
+    except (IOError, OSError):
+        return refs
+    with infile:
+        for line in infile.read().decode().splitlines():
+            if line.startswith(('#', '^')):
+                continue
+            value, _, name = line.partition(' ')
+            refs[name] = value
+    return refs
+
+
+def _read_loose_ref(git_dir, name):
+    "Read a loose ref, returning ``None`` if it doesn't exist."
+    try:
+        with open(os.path.join(git_dir, *name.split('/')), 'rb') as infile:
+            return infile.read().decode().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _tags_digest(git_dir, packed_refs=None):
+    "Compute a digest of the names and values of every tag."
+    if packed_refs is None:
+        packed_refs = _read_packed_refs(git_dir)
+    tags = dict(
+        (name, value) for name, value in packed_refs.items()
+        if name.startswith('refs/tags/'))
+    tags_dir = os.path.join(git_dir, 'refs', 'tags')
+    for dirpath, dirnames, filenames in os.walk(tags_dir):
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename), git_dir)
+            name = name.replace(os.sep, '/')
+            tags[name] = _read_loose_ref(git_dir, name)
+    digest = hashlib.sha1()
+    for name, value in sorted(tags.items()):
+        digest.update(('%s %s\n' % (name, value)).encode())
+    return digest.hexdigest()
+
+
+def _read_json(path):
+    "Read a JSON object from *path*, or an empty dict if that fails."
+    try:
+        with open(path, 'rb') as infile:
+            obj = json.loads(infile.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(obj, dict):
+        return {}
+    return obj
+
+
+def _write_json_atomically(path, obj):
+    """Write *obj* as JSON to *path*, ignoring failures.
+
+    The file is written under a temporary name and then renamed into place,
+    so that concurrent readers never see a partially-written file.
+
+    """
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(json.dumps(obj, sort_keys=True).encode('utf-8'))
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+class GitBackend(CommandBackend):
+    """The built-in git backend.
+
+    Its fingerprint is computed by reading ``HEAD`` and the tag refs straight
+    out of the git directory, without running git. Checking for uncommitted
+    changes uses ``git status`` without looking for untracked files, which
+    lets git use its index stat data and fsmonitor, if configured, instead of
+    reading every file.
+
+    Counting only the commits which touched a path requires walking history,
+    so the counts are saved in ``.git/vcversioner-path-commits.json``. Each
+    count is keyed by the tag, the most recent commit touching the path, and
+    the path, none of which change, so the walk is only ever done once for
+    each.
+
+    """
+
+    def __init__(self):
+        CommandBackend.__init__(self, 'git', '%(root)s/.git', (
+            'git', '--git-dir', '%(root)s/.git', 'describe', '--tags',
+            '--long'), dirty_args=(
+            'git', '--git-dir', '%(root)s/.git', '--work-tree', '%(root)s',
+            'status', '--porcelain', '--untracked-files=no'))
+
+    def fingerprint(self, substitute):
+        git_dir = substitute('%(root)s/.git')
+        packed_refs = _read_packed_refs(git_dir)
+        head = _read_loose_ref(git_dir, 'HEAD')
+        if head is not None and head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            head = _read_loose_ref(git_dir, ref) or packed_refs.get(ref)
+        if not head:
+            return None
+        return '%s %s' % (head, _tags_digest(git_dir, packed_refs))
+
+    # notes are saved along with the digest of the tags at the time, since
+    # adding a tag can change the version of a commit which already has one.
+    def read_note(self, substitute, ref, Popen):
+        git_dir = substitute('%(root)s/.git')
+        proc = Popen(
+            ['git', '--git-dir', git_dir, 'notes', '--ref', ref, 'show',
+             'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        fields = stdout.decode().split()
+        if proc.returncode != 0 or len(fields) != 3:
+            return None
+        raw_version, tags_label, tags_digest = fields
+        if (not _plausible_raw_version(raw_version)
+                or [tags_label, tags_digest]
+                != ['tags', _tags_digest(git_dir)]):
+            return None
+        return raw_version
+
+    def write_note(self, substitute, ref, raw_version, Popen):
+        git_dir = substitute('%(root)s/.git')
+        # adding a note makes a commit, which needs an identity that fresh
+        # clones (e.g. on CI machines) often don't have configured.
+        proc = Popen(
+            ['git', '-c', 'user.name=vcversioner',
+             '-c', 'user.email=vcversioner@localhost', '--git-dir', git_dir,
+             'notes', '--ref', ref, 'add', '-f', '-m', raw_version,
+             '-m', 'tags ' + _tags_digest(git_dir), 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.communicate()
+
+    def dependencies(self, substitute):
+        git_dir = substitute('%(root)s/.git')
+        if not os.path.isdir(git_dir):
+            # worktrees and submodules have a .git file pointing elsewhere,
+            # and none of the files below would exist.
+            return None
+        paths = [
+            os.path.join(git_dir, 'HEAD'),
+            os.path.join(git_dir, 'packed-refs'),
+            os.path.join(git_dir, 'logs', 'HEAD')]
+        head = _read_loose_ref(git_dir, 'HEAD')
+        if head is not None and head.startswith('ref: '):
+            ref = head[len('ref: '):].split('/')
+            paths.append(os.path.join(git_dir, *ref))
+            # if the branch is only in packed-refs, committing creates its
+            # loose ref, which changes the mtime of a directory above it.
+            for end in range(len(ref) - 1, 1, -1):
+                paths.append(os.path.join(git_dir, *ref[:end]))
+        # creating or deleting a tag changes the mtime of its directory.
+        tags_dir = os.path.join(git_dir, 'refs', 'tags')
+        for dirpath, dirnames, filenames in os.walk(tags_dir):
+            paths.append(dirpath)
+        return paths
+
+    def describe_scoped(self, substitute, Popen, path=None, tag_prefix=None):
+        root = substitute('%(root)s')
+        git_dir = substitute('%(root)s/.git')
+        def start(*args):
+            return Popen(
+                ['git', '--git-dir', git_dir, '--work-tree', root]
+                + list(args),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root)
+        def run(*args):
+            stdout, stderr = start(*args).communicate()
+            return stdout.strip().decode(), stderr.decode().splitlines()
+
+        def is_ancestor(ancestor, descendant):
+            proc = start('merge-base', '--is-ancestor', ancestor, descendant)
+            proc.communicate()
+            return proc.returncode == 0
+
+        # the tag always comes from HEAD, so that tagging HEAD is enough to
+        # release, even if HEAD didn't touch the path.
+        describe_args = ['describe', '--tags', '--long']
+        if tag_prefix is not None:
+            describe_args.extend(['--match', tag_prefix + '*'])
+        raw_version, output = run(*describe_args + ['HEAD'])
+        if path is None:
+            return raw_version, output
+        try:
+            tag, commits, sha = raw_version.rsplit('-', 2)
+        except ValueError:
+            return raw_version, output
+        path = substitute(path)
+        last_commit, output = run(
+            'log', '-1', '--format=%H %h', 'HEAD', '--', path)
+        if not last_commit:
+            return '', output
+        revision, sha = last_commit.split()
+        sha = 'g' + sha
+
+        tag_ref = 'refs/tags/' + tag
+        tag_id = (_read_loose_ref(git_dir, tag_ref)
+                  or _read_packed_refs(git_dir).get(tag_ref))
+        cache_path = os.path.join(git_dir, 'vcversioner-path-commits.json')
+        cache = _read_json(cache_path)
+        if not (isinstance(cache.get('counts'), dict)
+                and isinstance(cache.get('latest'), dict)):
+            cache = {'counts': {}, 'latest': {}}
+        key = ' '.join([tag_id or '', revision, path])
+        latest_key = ' '.join([tag_id or '', path])
+        if tag_id is not None and key in cache['counts']:
+            return '-'.join([tag, cache['counts'][key], sha]), output
+        if not is_ancestor(tag_ref, revision):
+            # the tag came after the last commit touching the path, so the
+            # path is exactly as it was when tagged.
+            return '-'.join([tag, '0', sha]), output
+
+        # every commit the tag can reach can also be reached from any
+        # revision described from that tag, so the count since the tag is the
+        # count at such a revision plus the count since then. this way, each
+        # new commit only needs its own commits counted.
+        base, base_commits = cache['latest'].get(latest_key, [None, '0'])
+        if base is not None and not is_ancestor(base, revision):
+            base, base_commits = None, '0'
+        commits, output = run(
+            'rev-list', '--count', '%s..%s' % (base or tag_ref, revision),
+            '--', path)
+        if not commits.isdigit():
+            return '', output
+        commits = str(int(base_commits) + int(commits))
+        if tag_id is not None:
+            cache['counts'][key] = commits
+            cache['latest'][latest_key] = [revision, commits]
+            _write_json_atomically(cache_path, cache)
+        return '-'.join([tag, commits, sha]), output
+
+
+_builtin_backends = [
+    GitBackend(),
+    CommandBackend('hg', '%(root)s/.hg', (
         'hg', 'log', '-R', '%(root)s', '-r', '.', '--template',
-        '{latesttag}-{latesttagdistance}-hg{node|short}')),
+        '{latesttag}-{latesttagdistance}-hg{node|short}'), dirty_args=(
+        'hg', 'status', '-R', '%(root)s', '--modified', '--added',
+        '--removed', '--deleted'), dependency_paths=(
+        '%(root)s/.hg/dirstate', '%(root)s/.hg/localtags',
+        '%(root)s/.hgtags')),
 ]
+_registered_backends = []
+_entry_point_backends = None
+
+
+def _iter_entry_points(group):
+    "Find entry points in *group*, with whatever API is available."
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return pkg_resources.iter_entry_points(group)
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])
+
+
+def _load_entry_point_backends():
+    backends = []
+    for ep in _iter_entry_points('vcversioner.backends'):
+        try:
+            backend = ep.load()
+        except Exception as e:
+            warnings.warn(
+                "couldn't load vcversioner backend %r: %s" % (ep.name, e))
+            continue
+        if isinstance(backend, type):
+            backend = backend()
+        backends.append(backend)
+    return backends
+
+
+def register_backend(backend):
+    """Add a :class:`Backend` to the ones :func:`find_version` tries.
+
+    Registered backends are tried in the order they were registered, before
+    any backends from entry points and before the built-in git and hg
+    backends. This means that registering a faster git backend will replace
+    the built-in one.
+
+    """
+
+    _registered_backends.append(backend)
+
+
+def get_backends():
+    """Return the list of backends :func:`find_version` tries, in order.
+
+    These are the backends passed to :func:`register_backend`, followed by
+    the ones advertised with ``vcversioner.backends`` entry points, followed
+    by the built-in backends. Entry points are only loaded the first time this
+    is called.
+
+    """
+
+    global _entry_point_backends
+    if _entry_point_backends is None:
+        _entry_point_backends = _load_entry_point_backends()
+    return _registered_backends + _entry_point_backends + _builtin_backends
+
+
+def _substituter(root):
+    "Build the substitutions dict and a function to apply it for *root*."
+    substitutions = {'pwd': os.getcwd()}
+    substitutions['root'] = root % substitutions
+    def substitute(val):
+        return _fix_path(val % substitutions)
+    return substitutions, substitute
+
+
+def _escape_make_path(path):
+    "Escape *path* for use in a make rule."
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+def _write_depfile(path, dependencies, open=open):
+    """Write a make-style dependency file.
+
+    The dependency file is its own target, listed as depending on each of
+    *dependencies* which exist; a file which doesn't exist can't be depended
+    on, and might be created later (e.g. ``packed-refs``), which changes its
+    directory anyway. If none of them exist, nothing is written, since a rule
+    without dependencies would never be run again.
+
+    Unlike the files the version is written to, the dependency file is
+    written every time, even if it's unchanged. Its mtime is then newer than
+    its dependencies, so the build tool knows it's up to date, while the
+    version files only change when the version does.
+
+    """
+
+    dependencies = [dep for dep in dependencies if os.path.exists(dep)]
+    if not dependencies:
+        return
+    with open(path, 'w') as outfile:
+        outfile.write('%s: %s\n' % (
+            _escape_make_path(path),
+            ' '.join(_escape_make_path(dep) for dep in dependencies)))
+
+
+def _render_c_header(version, path, macro_prefix='VCVERSIONER_'):
+    # the guard comes from the whole path, relative to the project root, so
+    # that headers with the same name in different directories can be
+    # included together.
+    guard = re.sub('[^A-Z0-9]', '_', (macro_prefix + path).upper())
+    def c_string(s):
+        return '"%s"' % (s.replace('\\', '\\\\').replace('"', '\\"'),)
+    return """/* This file is automatically generated by setup.py. */
+#ifndef {guard}
+#define {guard}
+#define {prefix}VERSION {version}
+#define {prefix}VERSION_COMMITS {commits}
+#define {prefix}VERSION_SHA {sha}
+#endif
+""".format(guard=guard, prefix=macro_prefix,
+           version=c_string(version.version),
+           commits=int(version.commits), sha=c_string(version.sha))
+
+
+def _render_shell(version, path, var_prefix='VCVERSIONER_'):
+    def shell_string(s):
+        return "'%s'" % (s.replace("'", "'\\''"),)
+    return """# This file is automatically generated by setup.py.
+{prefix}VERSION={version}
+{prefix}VERSION_COMMITS={commits}
+{prefix}VERSION_SHA={sha}
+""".format(prefix=var_prefix, version=shell_string(version.version),
+           commits=shell_string(version.commits),
+           sha=shell_string(version.sha))
+
+
+def _render_json(version, path):
+    return json.dumps({
+        'version': version.version,
+        'commits': version.commits,
+        'sha': version.sha,
+        'dirty': version.dirty,
+    }, indent=2, separators=(',', ': '), sort_keys=True) + '\n'
+
+
+_output_renderers = {
+    'c': _render_c_header,
+    'shell': _render_shell,
+    'json': _render_json,
+}
+
+
+def _version_from_pkg_info(path, open=open):
+    """Build a :class:`Version` from the ``Version`` header of a PKG-INFO file.
+
+    The number of commits is recovered from any ``.post`` suffix, but the
+    revision isn't recorded anywhere, so it's left empty.
+
+    """
+
+    with open(path, 'rb') as infile:
+        headers = infile.read().decode('utf-8').split('\n\n', 1)[0]
+    match = re.search(r'^Version:[ \t]*(\S+)', headers, re.MULTILINE)
+    if match is None:
+        print("%r doesn't contain a version." % (path,))
+        raise SystemExit(2)
+    version = match.group(1)
+    post = re.search(r'\.post(\d+)', version)
+    commits = post.group(1) if post else '0'
+    return Version(version, commits, '')
+
+
+class _TimeLimitedProcess(object):
+    "A process which is killed if it's waited on for too long."
+
+    def __init__(self, proc, args, timeout):
+        self.proc = proc
+        self.args = args
+        self.timeout = timeout
+        self.timed_out = False
+
+    def __getattr__(self, attr):
+        return getattr(self.proc, attr)
+
+    def _kill(self):
+        self.timed_out = True
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+
+    def communicate(self):
+        timer = threading.Timer(self.timeout, self._kill)
+        timer.start()
+        try:
+            stdout, stderr = self.proc.communicate()
+        finally:
+            timer.cancel()
+        if self.timed_out:
+            raise OSError('%r timed out after %s seconds' % (
+                self.args, self.timeout))
+        return stdout, stderr
+
+
+class _TimeLimitedPopen(object):
+    """Wrap a ``Popen`` so that processes are killed after *timeout* seconds.
+
+    A killed process raises ``OSError`` from ``communicate``, which is treated
+    the same as the VCS not being installed.
+
+    """
+
+    def __init__(self, Popen, timeout):
+        self.Popen = Popen
+        self.timeout = timeout
+
+    def __call__(self, args, **kwargs):
+        return _TimeLimitedProcess(
+            self.Popen(args, **kwargs), args, self.timeout)
+
+
+def _make_version(tag_version, commits, sha, include_dev_version=True,
+                  decrement_dev_version=None, strip_prefix='v'):
+    """Build a :class:`Version` from the parts of a raw version.
+
+    The parameters have the same meanings as for :func:`find_version`.
+
+    """
+
+    # remove leading prefix
+    if tag_version.startswith(strip_prefix):
+        tag_version = tag_version[len(strip_prefix):]
+
+    if sha.startswith('hg') and decrement_dev_version is None:
+        decrement_dev_version = True
+
+    if decrement_dev_version:
+        commits = str(int(commits) - 1)
+
+    if commits == '0' or not include_dev_version:
+        version = tag_version
+    else:
+        version = '%s.post%s' % (tag_version, commits)
+
+    return Version(version, commits, sha)
+
+
+def _plausible_raw_version(raw_version):
+    "Check whether a saved raw version is worth trying to parse."
+    return raw_version.count('-') >= 2
+
+
+def _version_cache_key(backend, substitute, parameters):
+    """Compute the cache key for a backend's output, if it has a fingerprint.
+
+    *parameters* is a list of JSON-serializable values which also affect the
+    output.
+
+    """
+
+    fingerprint = backend.fingerprint(substitute)
+    if fingerprint is None:
+        return None
+    key = json.dumps([backend.name, fingerprint] + parameters)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _version_cache_request(url, timeout, method, key, body=None):
+    """Make a request to a version cache server.
+
+    Returns the status and body of the response, or ``None`` if anything went
+    wrong, including not getting a response within *timeout* seconds.
+
+    """
+
+    try:
+        import http.client as httplib
+        from urllib.parse import urlsplit
+    except ImportError:
+        import httplib
+        from urlparse import urlsplit
+    import socket
+
+    if url.startswith('unix:'):
+        socket_path = url[len('unix:'):]
+        class UnixHTTPConnection(httplib.HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(socket_path)
+        make_connection = lambda: UnixHTTPConnection(
+            'localhost', timeout=timeout)
+        path = '/' + key
+    else:
+        parsed = urlsplit(url)
+        make_connection = lambda: httplib.HTTPConnection(
+            parsed.netloc, timeout=timeout)
+        path = parsed.path.rstrip('/') + '/' + key
+    try:
+        conn = make_connection()
+        try:
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+    except (socket.error, httplib.HTTPException):
+        return None
+
+
+def _version_cache_get(url, timeout, key):
+    "Look up VCS output in a version cache, returning ``None`` on any miss."
+    response = _version_cache_request(url, timeout, 'GET', key)
+    if response is None or response[0] != 200:
+        return None
+    try:
+        raw_version = response[1].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if not _plausible_raw_version(raw_version):
+        return None
+    return raw_version
+
+
+def _version_cache_put(url, timeout, key, raw_version):
+    "Store VCS output in a version cache, ignoring any failure."
+    _version_cache_request(
+        url, timeout, 'PUT', key, raw_version.encode('utf-8'))
+
+
+_default_version_file = '%(root)s/version.txt'
 
 
 def find_version(include_dev_version=True, root='%(pwd)s',
-                 version_file='%(root)s/version.txt', version_module_paths=(),
+                 version_file=_default_version_file, version_module_paths=(),
                  git_args=None, vcs_args=None, decrement_dev_version=None,
                  strip_prefix='v',
+                 version_module_template=_version_module_template,
+                 backends=None, version_override=None,
+                 version_override_env=None, check_dirty=False,
+                 dirty_paths=None, version_path=None, match_prefix=False,
+                 depfile=None, cache_url=None, cache_timeout=1.0,
+                 notes_ref=None,
+                 version_outputs=(), c_macro_prefix='VCVERSIONER_',
+                 shell_var_prefix='VCVERSIONER_', vcs_timeout=None,
                  Popen=subprocess.Popen, open=open):
     """Find an appropriate version number from version control.
 
@@ -81,13 +883,16 @@ def find_version(include_dev_version=True, root='%(pwd)s',
     :param version_file: The name of the file where version information will be
         saved. Reading and writing version files can be disabled altogether by
         setting this parameter to ``None``. Standard substitutions are
-        performed on this value.
+        performed on this value. If *version_path* is specified, this defaults
+        to ``version.txt`` inside *version_path* instead, so that projects
+        sharing a repository each get their own.
 
     :param version_module_paths: A list of python modules which will be
         automatically generated containing ``__version__`` and ``__sha__``
         attributes. For example, with ``package/_version.py`` as a version
         module path, ``package/__init__.py`` could do ``from package._version
-        import __version__, __sha__``.
+        import __version__, __sha__``. Standard substitutions are performed on
+        each path. Modules whose content wouldn't change aren't rewritten.
 
     :param git_args: **Deprecated.** Please use *vcs_args* instead.
 
@@ -108,11 +913,141 @@ def find_version(include_dev_version=True, root='%(pwd)s',
         version number tags. By default this is ``'v'``, but could be
         ``'debian/'`` for compatibility with ``git-dch``.
 
+    :param version_outputs: A list of ``(path, format)`` pairs of other files
+        to generate containing the version, for use outside of python. This
+        saves build steps written in other languages from having to start
+        python to find the version. The formats are:
+
+        ``'c'``
+          A C header defining ``VERSION`` and ``VERSION_SHA`` as string
+          literals and ``VERSION_COMMITS`` as an integer, each prefixed with
+          *c_macro_prefix*.
+
+        ``'shell'``
+          A file which can be sourced by a POSIX shell, setting ``VERSION``,
+          ``VERSION_COMMITS``, and ``VERSION_SHA``, each prefixed with
+          *shell_var_prefix*.
+
+        ``'json'``
+          A JSON object with ``version``, ``commits``, ``sha``, and ``dirty``
+          keys.
+
+        ``'python'``
+          The same as a path in *version_module_paths*.
+
+        As with version modules, files whose content wouldn't change aren't
+        rewritten. Standard substitutions are performed on each path.
+
+    :param c_macro_prefix: The prefix of the names of the macros defined in C
+        headers in *version_outputs*. The default keeps them from colliding
+        with e.g. autoconf's ``VERSION``; projects whose headers might be
+        included together should each use their own, e.g. ``'SPAM_'``.
+
+    :param shell_var_prefix: The prefix of the names of the variables set by
+        shell files in *version_outputs*. The default keeps sourcing them from
+        clobbering variables like ``VERSION`` which the sourcing script might
+        already use.
+
+    :param version_module_template: The template used to generate each
+        version module. It's formatted with ``str.format``, with ``version``,
+        ``commits``, and ``sha`` keys, each already a python string literal.
+
+    :param backends: A list of :class:`Backend`\\ s to try, in order, instead
+        of the ones returned by :func:`get_backends`. This is ignored if
+        *vcs_args* is specified.
+
+    :param version_override: A raw version, in the same
+        ``<tag>-<commits>-<revision>`` format VCS output is in, to use instead
+        of asking any VCS. For example, a release job which already knows it's
+        building the ``1.2`` tag could pass ``'1.2-0-gdeadbeef'``. It's parsed
+        just like VCS output, and the version file and version modules are
+        written from it as usual.
+
+    :param version_override_env: The name of an environment variable which,
+        if set to a non-empty value, is used as *version_override*. An explicit
+        *version_override* takes precedence. The :func:`setup` hook defaults
+        this to a variable named after the project; see
+        :func:`override_env_var`.
+
+    :param check_dirty: If ``True``, also check the working tree for
+        uncommitted changes, and if there are any, add a ``+dirty`` local
+        version suffix (e.g. ``1.0.post3+dirty``) and set the returned
+        version's *dirty* attribute. Untracked files are ignored. The check
+        runs concurrently with the VCS command getting the version, and is
+        skipped if the version didn't come from a VCS.
+
+    :param dirty_paths: A list of paths to restrict *check_dirty* to, e.g. the
+        directory of one package in a large repository. Paths are relative to
+        *root*, and standard substitutions are performed on each. By default,
+        the whole working tree is checked.
+
+    :param version_path: A path, relative to *root*, to version separately
+        from the rest of the repository. If specified, only commits since the
+        tag which touched this path are counted for the ``.post`` suffix, and
+        the revision is the most recent commit which touched it. The tag is
+        still found from ``HEAD``, so a tag on a later commit which didn't
+        touch this path gives that tag's version exactly. This is
+        for repositories containing many projects, where a project's version
+        shouldn't change unless the project itself did. Standard substitutions
+        are performed on this value. Only git supports this. Counts are saved
+        in ``.git/vcversioner-path-commits.json``, so that after a new commit
+        only the commits since the last run need counting.
+
+    :param match_prefix: If ``True``, only tags starting with *strip_prefix*
+        are considered. Combined with *version_path*, this allows each project
+        in a repository to have its own tags, e.g. ``spam/v1.0``, with
+        *strip_prefix* set to ``'spam/v'``. Only git supports this.
+
+    :param depfile: The name of a make-style dependency file to write,
+        listing the files the version was computed from, such as
+        ``.git/HEAD``, the current branch's ref, and ``packed-refs``. Build
+        tools like make and ninja can use this to skip running vcversioner
+        (and rebuilding anything depending on the files it writes) when none
+        of those files changed. The dependency file is its own target, and is
+        rewritten every time vcversioner runs, so it works as a stamp file;
+        the version file and version modules are still only rewritten when the
+        version changes. No dependency file is written if the files can't be
+        known, e.g. when using *version_override* or when ``.git`` is a file,
+        as in git worktrees and submodules. Changes to the working tree aren't
+        tracked, so this shouldn't be combined with *check_dirty*. Standard
+        substitutions are performed on this value.
+
+    :param cache_url: The URL of a version cache server shared between
+        machines, either ``http://host:port/`` or ``unix:/path/to/socket``. If
+        the backend can :meth:`~Backend.fingerprint` the repository, the
+        fingerprint and the parameters affecting the VCS output are used to
+        look up the VCS output in the cache before running the VCS, and the
+        VCS output is stored in the cache afterward. If the server can't be
+        reached, it's silently ignored. See :func:`make_cache_server` for the
+        protocol and a reference server.
+
+    :param cache_timeout: How many seconds to wait on the version cache server
+        at *cache_url* before giving up on it, for each of the lookup and the
+        store. This is added to the time taken whenever the server is
+        unreachable without the connection being refused outright.
+
+    :param notes_ref: The name of a git notes ref, e.g. ``'vcversioner'``, to
+        save VCS output in. If specified, the note on the current commit is
+        read first, and if there is one, it's used instead of running the VCS.
+        Otherwise, the VCS output is saved as a note on the current commit.
+        Pushing and fetching the notes ref shares the saved versions between
+        clones. Notes are saved with a digest of the repository's tags, and a
+        note is ignored (and then replaced) if the tags have changed since, so
+        adding a tag never leaves a stale version behind. This is ignored with
+        *version_path* or *match_prefix*, and only git supports it.
+
+    :param vcs_timeout: The number of seconds to let each VCS command run
+        for before killing it. A VCS command which is killed is treated the
+        same as the VCS not being installed, so the version file is used
+        instead; if the *check_dirty* check is killed, the working tree is
+        treated as clean. By default, there's no limit.
+
     :param Popen: Defaults to ``subprocess.Popen``. This is for testing.
 
     :param open: Defaults to ``open``. This is for testing.
 
-    *root*, *version_file*, and *git_args* each support some substitutions:
+    *root*, *version_file*, *version_module_paths*, and *git_args* each support
+    some substitutions:
 
     ``%(root)s``
       The value provided for *root*. This is not available for the *root*
@@ -124,6 +1059,12 @@ def find_version(include_dev_version=True, root='%(pwd)s',
     ``/`` will automatically be translated into the correct path separator for
     the current platform, such as ``:`` or ``\``.
 
+    If *vcs_args* isn't specified and there's a ``PKG-INFO`` file in *root*,
+    *root* is assumed to be an unpacked sdist. No VCS is looked for, and
+    nothing is written; the version is read from *version_file* if it exists,
+    and from ``PKG-INFO`` otherwise. A version read from ``PKG-INFO`` has an
+    empty *sha*, since it isn't recorded there.
+
     ``vcversioner`` will perform automatic VCS detection with the following
     directories, in order, and run the specified commands.
 
@@ -139,14 +1080,28 @@ def find_version(include_dev_version=True, root='%(pwd)s',
           '{latesttag}-{latesttagdistance}-hg{node|short}'``. ``-R`` is
           similarly used to prevent contamination.
 
+    Any backends added with :func:`register_backend` or a
+    ``vcversioner.backends`` entry point are tried before these.
+
     """
 
-    substitutions = {'pwd': os.getcwd()}
-    substitutions['root'] = root % substitutions
-    def substitute(val):
-        return _fix_path(val % substitutions)
-    if version_file is not None:
+    substitutions, substitute = _substituter(root)
+    if version_file == _default_version_file and version_path is not None:
+        version_file = os.path.join(
+            substitute('%(root)s'), substitute(version_path), 'version.txt')
+    elif version_file is not None:
         version_file = substitute(version_file)
+    if depfile is not None:
+        depfile = substitute(depfile)
+    if vcs_timeout is not None:
+        Popen = _TimeLimitedPopen(Popen, vcs_timeout)
+    outputs = [(substitute(path), 'python') for path in version_module_paths]
+    outputs.extend(
+        (substitute(path), format) for path, format in version_outputs)
+    for path, format in outputs:
+        if format != 'python' and format not in _output_renderers:
+            print('%r has an unknown output format %r.' % (path, format))
+            raise SystemExit(2)
 
     if git_args is not None:
         warnings.warn(
@@ -154,30 +1109,92 @@ def find_version(include_dev_version=True, root='%(pwd)s',
             DeprecationWarning)
         vcs_args = git_args
 
-    if vcs_args is None:
-        for path, args in _vcs_args_by_path:
-            if os.path.exists(substitute(path)):
-                vcs_args = args
-                break
+    if version_override is None and version_override_env is not None:
+        version_override = os.environ.get(version_override_env) or None
 
     raw_version = None
     vcs_output = []
+    backend = None
+    pkg_info = substitute('%(root)s/PKG-INFO')
+    from_sdist = False
+
+    if version_override is not None:
+        # the version is already known, so don't bother with any VCS.
+        raw_version = version_override
+        version_source = 'the version override'
+    elif vcs_args is not None:
+        backend = CommandBackend(None, None, vcs_args)
+    elif os.path.exists(pkg_info):
+        # this is an unpacked sdist, so there's no VCS to ask, and everything
+        # which would be written was already written when it was made.
+        from_sdist = True
+        if version_file is None or not os.path.exists(version_file):
+            if depfile is not None:
+                _write_depfile(depfile, [pkg_info], open=open)
+            return _version_from_pkg_info(pkg_info, open=open)
+    else:
+        if backends is None:
+            backends = get_backends()
+        for candidate in backends:
+            if candidate.detect(substitute):
+                backend = candidate
+                break
 
-    if vcs_args is not None:
-        vcs_args = [substitute(arg) for arg in vcs_args]
+    dirty_check = None
+    if backend is not None and check_dirty:
+        try:
+            dirty_check = backend.start_dirty_check(
+                substitute, dirty_paths, Popen)
+        except OSError:
+            pass
 
+    if backend is not None:
         # try to pull the version from some VCS, or (perhaps) fall back on a
         # previously-saved version.
+        tag_prefix = strip_prefix if match_prefix else None
+        noted = cache_key = cached = None
+        use_notes = (
+            notes_ref is not None and version_path is None
+            and tag_prefix is None)
+        if use_notes:
+            try:
+                noted = backend.read_note(substitute, notes_ref, Popen)
+            except OSError:
+                pass
+        if noted is None and cache_url is not None:
+            cache_key = _version_cache_key(backend, substitute, [
+                strip_prefix, decrement_dev_version, version_path,
+                tag_prefix])
+        if cache_key is not None:
+            cached = _version_cache_get(cache_url, cache_timeout, cache_key)
         try:
-            proc = Popen(vcs_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if noted is not None:
+                raw_version = noted
+            elif cached is not None:
+                raw_version = cached
+            elif version_path is None and tag_prefix is None:
+                raw_version, vcs_output = backend.describe(substitute, Popen)
+            else:
+                raw_version, vcs_output = backend.describe_scoped(
+                    substitute, Popen, version_path, tag_prefix)
         except OSError:
             pass
+        except NotImplementedError:
+            print("%s can't limit versions to a path or tag prefix." % (
+                backend.display(substitute),))
+            raise SystemExit(2)
         else:
-            stdout, stderr = proc.communicate()
-            raw_version = stdout.strip().decode()
-            vcs_output = stderr.decode().splitlines()
             version_source = 'VCS'
-        failure = '%r failed' % (vcs_args,)
+            if cache_key is not None and cached is None and raw_version:
+                _version_cache_put(
+                    cache_url, cache_timeout, cache_key, raw_version)
+            if use_notes and noted is None and raw_version:
+                try:
+                    backend.write_note(
+                        substitute, notes_ref, raw_version, Popen)
+                except OSError:
+                    pass
+        failure = '%s failed' % (backend.display(substitute),)
     else:
         failure = 'no VCS could be detected in %(root)r' % substitutions
 
@@ -213,35 +1230,62 @@ def find_version(include_dev_version=True, root='%(pwd)s',
         show_vcs_output()
         raise SystemExit(2)
 
-    # remove leading prefix
-    if tag_version.startswith(strip_prefix):
-        tag_version = tag_version[len(strip_prefix):]
+    if version_file is not None and not from_sdist:
+        _write_if_changed(version_file, raw_version, open=open)
 
-    if version_file is not None:
-        with open(version_file, 'w') as outfile:
-            outfile.write(raw_version)
+    result = _make_version(
+        tag_version, commits, sha, include_dev_version=include_dev_version,
+        decrement_dev_version=decrement_dev_version, strip_prefix=strip_prefix)
 
-    if sha.startswith('hg') and decrement_dev_version is None:
-        decrement_dev_version = True
+    dirty = False
+    if dirty_check is not None:
+        try:
+            dirty = dirty_check()
+        except OSError:
+            # e.g. the check timed out. as when it can't be started at all,
+            # the working tree is assumed to be clean.
+            pass
+    if dirty and version_source == 'VCS':
+        result = Version(
+            result.version + '+dirty', result.commits, result.sha, True)
 
-    if decrement_dev_version:
-        commits = str(int(commits) - 1)
+    renderers = dict(_output_renderers)
+    renderers['c'] = lambda version, path: _render_c_header(
+        version, os.path.relpath(path, substitute('%(root)s')), c_macro_prefix)
+    renderers['shell'] = lambda version, path: _render_shell(
+        version, path, shell_var_prefix)
+    renderers['python'] = lambda version, path: version_module_template.format(
+        version=_literal(version.version), commits=_literal(version.commits),
+        sha=_literal(version.sha))
+    if not from_sdist:
+        for path, format in outputs:
+            _write_if_changed(
+                path, renderers[format](result, path), open=open)
 
-    if commits == '0' or not include_dev_version:
-        version = tag_version
-    else:
-        version = '%s.post%s' % (tag_version, commits)
+    if depfile is not None:
+        dependencies = None
+        if backend is not None:
+            dependencies = backend.dependencies(substitute)
+        if version_source == repr(version_file):
+            dependencies = (dependencies or []) + [version_file]
+        if dependencies is not None:
+            _write_depfile(depfile, dependencies, open=open)
 
-    for path in version_module_paths:
-        with open(path, 'w') as outfile:
-            outfile.write("""
-# This file is automatically generated by setup.py.
-__version__ = {0}
-__sha__ = {1}
-__revision__ = {1}
-""".format(repr(version).lstrip('u'), repr(sha).lstrip('u')))
+    return result
 
-    return Version(version, commits, sha)
+
+def override_env_var(project_name):
+    """Return the name of the version override variable for a project.
+
+    This is ``VCVERSIONER_<project>_VERSION``, where the project name is upper
+    cased and anything which isn't a letter or a number is replaced with
+    ``_``. For example, the variable for ``spam-eggs`` is
+    ``VCVERSIONER_SPAM_EGGS_VERSION``.
+
+    """
+
+    name = re.sub('[^A-Z0-9]', '_', project_name.upper())
+    return 'VCVERSIONER_%s_VERSION' % (name,)
 
 
 def setup(dist, attr, value):
@@ -258,8 +1302,443 @@ def setup(dist, attr, value):
       )
 
     The parameter to the ``vcversioner`` argument is a dict of keyword
-    arguments which :func:`find_version` will be called with.
+    arguments which :func:`find_version` will be called with. Unless specified
+    there, *version_override_env* defaults to the variable
+    :func:`override_env_var` returns for the project's name.
 
     """
 
+    value = dict(value)
+    name = getattr(dist.metadata, 'name', None)
+    if name and 'version_override_env' not in value:
+        value[str('version_override_env')] = override_env_var(name)
     dist.metadata.version = find_version(**value).version
+
+
+class _CachedProcess(object):
+    """A process shared between every caller running the same command.
+
+    The process is only waited on the first time any of them calls
+    ``communicate``, so a process can still run concurrently with others.
+
+    """
+
+    def __init__(self, popen, key):
+        self.popen = popen
+        self.key = key
+        self.returncode = None
+
+    def communicate(self):
+        stdout, stderr, self.returncode = self.popen._finish(self.key)
+        return stdout, stderr
+
+    def kill(self):
+        self.popen._kill(self.key)
+
+
+class _CachingPopen(object):
+    """Wrap a ``Popen`` so that each distinct command is only run once.
+
+    Failures to spawn or wait for a command are remembered as well, so a
+    missing or hung VCS program is only waited on once. A command which is
+    killed, e.g. by a project's own *vcs_timeout*, is remembered as having
+    failed rather than by its partial output.
+
+    """
+
+    def __init__(self, Popen):
+        self.Popen = Popen
+        self._results = {}
+        self._killed = set()
+
+    def __call__(self, args, **kwargs):
+        key = tuple(args), kwargs.get('cwd')
+        if key not in self._results:
+            try:
+                self._results[key] = self.Popen(args, **kwargs)
+            except OSError as e:
+                self._results[key] = e
+        if isinstance(self._results[key], OSError):
+            raise self._results[key]
+        return _CachedProcess(self, key)
+
+    def _finish(self, key):
+        result = self._results[key]
+        if isinstance(result, OSError):
+            raise result
+        if not isinstance(result, tuple):
+            try:
+                stdout, stderr = result.communicate()
+                if key in self._killed:
+                    raise OSError('%r was killed' % (key[0],))
+            except OSError as e:
+                self._results[key] = e
+                raise
+            result = self._results[key] = stdout, stderr, result.returncode
+        return result
+
+    def _kill(self, key):
+        result = self._results[key]
+        if isinstance(result, (OSError, tuple)):
+            return
+        self._killed.add(key)
+        result.kill()
+
+
+class _CachingBackend(object):
+    """Wrap a :class:`Backend` so descriptions are shared by fingerprint.
+
+    Backends without a fingerprint for the repository state aren't cached
+    here, but command-based backends still benefit from
+    :class:`_CachingPopen`.
+
+    """
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    def __getattr__(self, attr):
+        return getattr(self.backend, attr)
+
+    def describe(self, substitute, Popen):
+        fingerprint = self.backend.fingerprint(substitute)
+        if fingerprint is None:
+            return self.backend.describe(substitute, Popen)
+        key = self.backend.name, fingerprint
+        if key not in self.cache:
+            self.cache[key] = self.backend.describe(substitute, Popen)
+        return self.cache[key]
+
+    def describe_scoped(self, substitute, Popen, path=None, tag_prefix=None):
+        fingerprint = self.backend.fingerprint(substitute)
+        if fingerprint is None:
+            return self.backend.describe_scoped(
+                substitute, Popen, path, tag_prefix)
+        key = self.backend.name, fingerprint, path, tag_prefix
+        if key not in self.cache:
+            self.cache[key] = self.backend.describe_scoped(
+                substitute, Popen, path, tag_prefix)
+        return self.cache[key]
+
+
+def stamp_versions(manifest, vcs_timeout=None, Popen=subprocess.Popen,
+                   open=open):
+    """Find versions for many projects at once.
+
+    This is the bulk equivalent of calling :func:`find_version` once per
+    project, but in a single process, and with each distinct VCS command run
+    only once. Backends which can :meth:`~Backend.fingerprint` the
+    repository state have their descriptions shared in the same way. Projects
+    sharing a repository root therefore share the cost of asking the VCS for a
+    version, which makes it cheap enough to regenerate every version module in
+    a large repository as a pre-commit or pre-build step. As with
+    :func:`find_version`, only files whose content changed are rewritten.
+
+    :param manifest: An iterable of dicts, one per project, each containing
+        the keyword arguments :func:`find_version` will be called with. Since
+        VCS detection only looks in *root*, *root* should be the repository
+        root (which it is by default, when run from there), with paths to each
+        project's files given relative to it. For example::
+
+          [{'version_module_paths': ['spam/spam/_version.py'],
+            'version_file': 'spam/version.txt'},
+           {'version_module_paths': ['eggs/eggs/_version.py'],
+            'version_file': 'eggs/version.txt'}]
+
+    :param vcs_timeout: As for :func:`find_version`, but applied to every
+        project. A command which times out isn't run again for later projects.
+
+    :param Popen: Defaults to ``subprocess.Popen``. This is for testing.
+
+    :param open: Defaults to ``open``. This is for testing.
+
+    :returns: A list of :class:`Version`\\ s, in the same order as *manifest*.
+
+    """
+
+    if vcs_timeout is not None:
+        Popen = _TimeLimitedPopen(Popen, vcs_timeout)
+    Popen = _CachingPopen(Popen)
+    describe_cache = {}
+    versions = []
+    for kwargs in manifest:
+        kwargs = dict((str(k), v) for k, v in kwargs.items())
+        kwargs.setdefault('Popen', Popen)
+        kwargs.setdefault('open', open)
+        kwargs['backends'] = [
+            _CachingBackend(backend, describe_cache)
+            for backend in kwargs.get('backends') or get_backends()]
+        versions.append(find_version(**kwargs))
+    return versions
+
+
+def iter_versions(revisions='HEAD', root='%(pwd)s', include_dev_version=True,
+                  decrement_dev_version=False, strip_prefix='v',
+                  match_prefix=False, Popen=subprocess.Popen):
+    """Find the version of every commit in a range of git history.
+
+    Calling :func:`find_version` for each commit in a long history means
+    running git for each of them, with each run walking back to the most
+    recent tag. Instead, this walks the history once, parents before their
+    children, carrying the most recent tag and the number of commits since it
+    along. ``git describe`` is only run again at merges, and where the walk
+    moves from one branch to another, so the versions are the same as what
+    :func:`find_version` reports. Results are generated as the walk goes, so
+    memory use doesn't grow with the length of the history. Commits with no
+    tag before them are skipped.
+
+    :param revisions: The range of commits to walk, in any form ``git log``
+        accepts, e.g. ``'v1.0..HEAD'``.
+
+    :param root: The directory of the repository root, as for
+        :func:`find_version`.
+
+    :param match_prefix: If ``True``, only tags starting with *strip_prefix*
+        are considered.
+
+    *include_dev_version*, *decrement_dev_version*, and *strip_prefix* have the
+    same meanings as for :func:`find_version`.
+
+    :returns: An iterator of ``(commit id, version)`` tuples, parents
+        before their children, where each version is a :class:`Version`. If
+        git fails, e.g. because *revisions* isn't a valid range, the failure
+        and git's output are printed and ``SystemExit`` is raised, as with
+        :func:`find_version`.
+
+    """
+
+    substitutions, substitute = _substituter(root)
+    git = ['git', '--git-dir', substitute('%(root)s/.git')]
+    def fail(args, stderr):
+        print('%r failed.' % (git + args,))
+        lines = stderr.decode().splitlines()
+        if lines:
+            print('-- VCS output follows --')
+            for line in lines:
+                print(line)
+        raise SystemExit(2)
+
+    def run_unchecked(args):
+        proc = Popen(
+            git + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        return proc.returncode, stdout.decode().strip(), stderr
+
+    def run(*args):
+        returncode, stdout, stderr = run_unchecked(list(args))
+        if returncode != 0:
+            fail(list(args), stderr)
+        return stdout
+
+    # when several tags point at one commit, prefer the newest one, as git
+    # describe does.
+    tags = {}
+    for line in run(
+            'for-each-ref', '--sort=-creatordate',
+            '--format=%(objectname) %(*objectname) %(refname)',
+            'refs/tags').splitlines():
+        obj, peeled, ref = line.split(' ', 2)
+        name = ref[len('refs/tags/'):]
+        if match_prefix and not name.startswith(strip_prefix):
+            continue
+        tags.setdefault(peeled or obj, name)
+
+    def describe(commit):
+        describe_args = ['describe', '--tags', '--long']
+        if match_prefix:
+            describe_args.extend(['--match', strip_prefix + '*'])
+        # describe fails if there's no tag to find.
+        returncode, raw_version, stderr = run_unchecked(
+            describe_args + [commit])
+        if returncode != 0:
+            return None
+        try:
+            tag, commits, sha = raw_version.rsplit('-', 2)
+        except ValueError:
+            fail(describe_args + [commit], stderr)
+        return tag, int(commits)
+
+    log_args = [
+        'log', '--topo-order', '--reverse', '--format=%H %h %P', revisions]
+    # stderr goes to a file, since nothing reads it until the walk is over,
+    # and a full pipe would block git.
+    stderr = tempfile.TemporaryFile()
+    try:
+        proc = Popen(git + log_args, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            previous = latest = None
+            for line in proc.stdout:
+                fields = line.decode().split()
+                commit, abbrev, parents = fields[0], fields[1], fields[2:]
+                if commit in tags:
+                    latest = tags[commit], 0
+                elif parents == [previous]:
+                    if latest is not None:
+                        latest = latest[0], latest[1] + 1
+                elif parents:
+                    # a merge, or the walk started partway through history
+                    # or moved on to another branch, so the commit's own
+                    # parent wasn't the last one seen.
+                    latest = describe(commit)
+                else:
+                    latest = None
+                previous = commit
+                if latest is None:
+                    continue
+                yield commit, _make_version(
+                    latest[0], str(latest[1]), 'g' + abbrev,
+                    include_dev_version=include_dev_version,
+                    decrement_dev_version=decrement_dev_version,
+                    strip_prefix=strip_prefix)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            stderr.seek(0)
+            fail(log_args, stderr.read())
+    finally:
+        stderr.close()
+
+
+def benchmark_backends(root='%(pwd)s', repeat=5, backends=None,
+                       Popen=subprocess.Popen):
+    """Time how long each backend takes to describe a repository.
+
+    Every backend which detects a repository in *root* is run *repeat* times,
+    and the fastest run is kept. This is useful for comparing a custom backend
+    against the built-in ones.
+
+    :param backends: The backends to compare. Defaults to the ones returned by
+        :func:`get_backends`.
+
+    :returns: A list of ``(name, seconds)`` tuples, in the order the backends
+        were tried. *seconds* is ``None`` for a backend which couldn't be run,
+        such as when its VCS program isn't installed.
+
+    """
+
+    substitutions, substitute = _substituter(root)
+    if backends is None:
+        backends = get_backends()
+    results = []
+    for backend in backends:
+        if not backend.detect(substitute):
+            continue
+        times = []
+        try:
+            for x in range(repeat):
+                start = timeit.default_timer()
+                backend.describe(substitute, Popen)
+                times.append(timeit.default_timer() - start)
+        except OSError:
+            results.append((backend.name, None))
+        else:
+            results.append((backend.name, min(times)))
+    return results
+
+
+def make_cache_server(address):
+    """Make a reference version cache server.
+
+    The protocol is plain HTTP: ``GET /<key>`` returns the cached VCS output
+    for a key with a 200 response, or a 404 response if there isn't any, and
+    ``PUT /<key>`` stores the request body as the VCS output for a key. Keys
+    are hex digests computed by :func:`find_version`, so any HTTP server or
+    cache which supports that is compatible. This server just keeps
+    everything in memory.
+
+    :param address: Either a ``(host, port)`` tuple to listen on TCP, or a
+        ``unix:/path/to/socket`` string to listen on a Unix socket.
+
+    :returns: A ``socketserver`` server. Call its ``serve_forever`` method to
+        run it. Its ``cache`` attribute is the dict of cached values.
+
+    """
+
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import socketserver
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        import SocketServer as socketserver
+
+    class CacheRequestHandler(BaseHTTPRequestHandler):
+        def respond(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            # the client may have hung up already if there's nothing to read.
+            if body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            value = self.server.cache.get(self.path)
+            if value is None:
+                self.respond(404)
+            else:
+                self.respond(200, value)
+
+        def do_PUT(self):
+            length = int(self.headers.get('Content-Length', 0))
+            self.server.cache[self.path] = self.rfile.read(length)
+            self.respond(204)
+
+        def address_string(self):
+            return str(self.client_address)
+
+        def log_message(self, format, *args):
+            pass
+
+    if isinstance(address, tuple):
+        server = HTTPServer(address, CacheRequestHandler)
+    else:
+        server = socketserver.UnixStreamServer(
+            address[len('unix:'):], CacheRequestHandler)
+    server.cache = {}
+    return server
+
+
+_usage = """usage: python -m vcversioner stamp MANIFEST
+       python -m vcversioner benchmark [ROOT]
+       python -m vcversioner cache-server [HOST:PORT | unix:PATH]"""
+
+
+def main(argv=None):
+    """Run vcversioner from the command line.
+
+    ``python -m vcversioner stamp manifest.json`` calls :func:`stamp_versions`
+    with the JSON list of objects in ``manifest.json`` and prints each version
+    found. ``python -m vcversioner benchmark`` prints the output of
+    :func:`benchmark_backends`, optionally for a given project root.
+    ``python -m vcversioner cache-server`` runs the server from
+    :func:`make_cache_server`, by default on ``localhost:8642``.
+
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 2 and argv[0] == 'stamp':
+        with open(argv[1], 'rb') as infile:
+            manifest = json.loads(infile.read().decode('utf-8'))
+        for version in stamp_versions(manifest):
+            _print(version.version)
+    elif 1 <= len(argv) <= 2 and argv[0] == 'benchmark':
+        for name, seconds in benchmark_backends(*argv[1:]):
+            if seconds is None:
+                _print('%s: failed to run' % (name,))
+            else:
+                _print('%s: %.1f ms' % (name, seconds * 1000))
+    elif 1 <= len(argv) <= 2 and argv[0] == 'cache-server':
+        address = argv[1] if len(argv) == 2 else 'localhost:8642'
+        if not address.startswith('unix:'):
+            host, _, port = address.rpartition(':')
+            address = host, int(port)
+        make_cache_server(address).serve_forever()
+    else:
+        _print(_usage, file=sys.stderr)
+        raise SystemExit(2)
+
+
+if __name__ == '__main__':
+    main()